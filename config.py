@@ -63,6 +63,9 @@ class RootConfig(ConfigObject):
     UNI_CONFIG_DB_FILE = os.path.join(UNI_CONFIG_DIR, 'hibernate.properties')
 
     UNI_WEBAPP = os.path.join(WORK_DIR, 'webapp')
+    ARTIFACT_CACHE = os.path.join(WORK_DIR, 'artifact_cache')
+    # при поэтапном обновлении UNI_WEBAPP - симлинк на один из двух слотов
+    UNI_WEBAPP_SLOTS = os.path.join(WORK_DIR, 'webapp_slots')
 
     UNI_PORT = 8080
     UNI_DEBUG_PORT = 8081
@@ -70,6 +73,8 @@ class RootConfig(ConfigObject):
     def __init__(self):
         self.log_level = 'INFO'
         self.db_type = Pgdocker.DB_TYPE
+        # Скачивать и распаковывать сборку при работающем томкате, останавливать его только на подмену webapp
+        self.staged_deploy = True
         self.catalina_opts = "-Dapp.install.path={} -Xmx1500m -Djava.awt.headless=true -Dfile.encoding=UTF-8 -Xdebug -Xnoagent -Xrunjdwp:transport=dt_socket,server=y,suspend=n,address={}".format(
                 RootConfig.WORK_DIR, str(RootConfig.UNI_DEBUG_PORT))
 
@@ -125,9 +130,12 @@ class RootConfig(ConfigObject):
                 'tornado.application': {'level': logging.ERROR},
                 '[test tools pgdocker]': {},
                 '[test tools postgres]': {},
+                '[test tools compression]': {},
                 '[test tools mssql]': {},
                 '[test tools main]': {},
                 '[test tools jenkins]': {},
+                '[test tools webapp]': {},
+                '[test tools process]': {},
                 '[test tools config]': {},
             },
             'root': {
@@ -162,10 +170,35 @@ class DBConfig(ConfigObject):
             # директория на сервере mssql куда складывать базы (должна существовать)
             self.mssql_db_dir = ConfigObject.UNDEFINED
             self.port = '1433'
+            # BACKUP ... WITH COMPRESSION. Express и Web редакции сжатие не поддерживают, бэкап на них упадет,
+            # поэтому включается явно
+            self.mssql_backup_compression = False
+            # На сколько файлов делить бэкап. Файлы раскладываются по очереди в директории mssql_backup_dirs
+            # (через запятую, на сервере mssql), по умолчанию все в backup_dir
+            self.mssql_backup_stripes = 1
+            self.mssql_backup_dirs = None
+            # BUFFERCOUNT и MAXTRANSFERSIZE (в байтах, кратно 64 КБ, до 4 МБ) для BACKUP и RESTORE, None - как решит сервер
+            self.mssql_backup_buffer_count = None
+            self.mssql_backup_max_transfer_size = None
 
         if db_type in (Pgdocker.DB_TYPE, Postgres.DB_TYPE):
             self.backup_dir = os.path.join(RootConfig.WORK_DIR, 'backup')
             self.postgres_ignore_restore_errors = True
+            # Число потоков pg_dump/pg_restore. Больше 1 - бэкап в формате директории и параллельное восстановление
+            self.postgres_jobs = os.cpu_count() or 1
+            # Максимум соединений с одной базой для коротких sql запросов
+            self.postgres_pool_size = 2
+            # Потоковое сжатие бэкапов: none, gzip, zstd
+            self.backup_compression = 'zstd'
+            self.backup_compression_level = 3
+            # Восстановленные базы сохраняются шаблонами на сервере, повторное восстановление того же бэкапа
+            # делается копированием шаблона. Максимальное количество шаблонов (0 - не использовать) и их размер.
+            # Каждый шаблон - полная копия базы на сервере, а первое восстановление бэкапа дополнительно копирует
+            # базу в шаблон. Поэтому по умолчанию выключено, включать когда на сервере хватает места
+            self.postgres_templates = 0
+            self.postgres_templates_max_size_gb = 100
+            # Вывод pg_dump, pg_restore и psql, по файлу на утилиту. Перезаписывается при каждом запуске
+            self.console_log_dir = os.path.join(RootConfig.WORK_DIR, 'console_logs')
 
         if db_type == Postgres.DB_TYPE:
             self.port = '5432'
@@ -183,6 +216,8 @@ class DBConfig(ConfigObject):
             self.password = 'postgres'
             # образ базы данных
             self.pgdocker_image = 'tandemservice/postgres'
+            # сколько секунд ждать готовности сервера после запуска контейнера
+            self.pgdocker_start_timeout = 60
 
 
 class JenkinsConfig(ConfigObject):
@@ -194,3 +229,12 @@ class JenkinsConfig(ConfigObject):
         self.password = ConfigObject.UNDEFINED
         self.project = 'product_uni'
         self.branch = None
+        # Размер локального кэша скачанных сборок
+        self.artifact_cache_size_gb = 5
+        # Переписывать в webapp только изменившиеся файлы сборки
+        self.incremental_deploy = True
+        # Фоновая предзагрузка последней успешной сборки: период опроса в секундах (0 - выключена),
+        # ограничение скорости в МБ/с (0 - без ограничения) и сколько места оставлять свободным на диске
+        self.prefetch_interval = 300
+        self.prefetch_bandwidth_mb = 0
+        self.prefetch_min_free_gb = 5
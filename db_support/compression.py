@@ -0,0 +1,130 @@
+import logging
+import os
+import shutil
+import signal
+import subprocess
+
+log = logging.getLogger('[test tools compression]')
+
+
+class Compression(object):
+    """
+    Потоковое сжатие бэкапов внешними утилитами. Данные идут через пайп, несжатый файл на диск не пишется
+    """
+    NONE = 'none'
+    GZIP = 'gzip'
+    ZSTD = 'zstd'
+
+    EXTENSIONS = {GZIP: '.gz', ZSTD: '.zst'}
+
+    def __init__(self, method, level):
+        if method not in (self.NONE, self.GZIP, self.ZSTD):
+            raise RuntimeError('Unsupported backup compression %s' % method)
+        self.method = method
+        # из переменных среды приходит строка
+        self.level = int(level)
+
+    @property
+    def enabled(self):
+        return self.method != self.NONE
+
+    def path(self, base_path):
+        """
+        Путь к файлу бэкапа с расширением текущего метода сжатия
+        """
+        return base_path + self.EXTENSIONS.get(self.method, '')
+
+    def existing_path(self, base_path):
+        """
+        Самый свежий из бэкапов base_path, сжатых любым методом. None если бэкапа нет
+        """
+        candidates = [p for p in self._candidates(base_path) if os.path.exists(p)]
+        if not candidates:
+            return None
+        return max(candidates, key=os.path.getmtime)
+
+    @staticmethod
+    def remove_stale(base_path, actual_path):
+        """
+        Удаляет бэкапы base_path в других форматах, кроме actual_path, чтобы они не занимали место на диске
+        """
+        for p in Compression._candidates(base_path):
+            if p != actual_path and os.path.exists(p):
+                log.debug('Remove stale backup %s', p)
+                if os.path.isdir(p):
+                    shutil.rmtree(p)
+                else:
+                    os.remove(p)
+
+    @staticmethod
+    def _candidates(base_path):
+        return [base_path] + [base_path + ext for ext in Compression.EXTENSIONS.values()]
+
+    @staticmethod
+    def is_compressed(path):
+        return os.path.isfile(path) and os.path.splitext(path)[1] in Compression.EXTENSIONS.values()
+
+    def compress_args(self):
+        threads = str(os.cpu_count() or 1)
+        if self.method == self.ZSTD:
+            return ['zstd', '-q', '-c', '-T' + threads, '-{}'.format(self.level)]
+        # pigz - многопоточный gzip, если его нет то обычный
+        if shutil.which('pigz'):
+            return ['pigz', '-c', '-p', threads, '-{}'.format(self.level)]
+        return ['gzip', '-c', '-{}'.format(self.level)]
+
+    @staticmethod
+    def decompress_args(path):
+        if path.endswith(Compression.EXTENSIONS[Compression.ZSTD]):
+            return ['zstd', '-q', '-d', '-c', path]
+        return ['pigz' if shutil.which('pigz') else 'gzip', '-d', '-c', path]
+
+    def start_compressor(self, out_file):
+        """
+        Запускает процесс сжатия. Данные пишутся в stdin процесса, результат в out_file
+        """
+        args = self.compress_args()
+        log.debug('Start compressor: %s', ' '.join(args))
+        return subprocess.Popen(args, stdin=subprocess.PIPE, stdout=out_file)
+
+    @staticmethod
+    def start_decompressor(path):
+        """
+        Запускает процесс распаковки path. Данные читаются из stdout процесса
+        """
+        args = Compression.decompress_args(path)
+        log.debug('Start decompressor: %s', ' '.join(args))
+        return subprocess.Popen(args, stdout=subprocess.PIPE)
+
+    @staticmethod
+    def finish(process, timeout):
+        """
+        Ждет завершения процесса сжатия/распаковки и проверяет код возврата.
+        Распаковка, убитая SIGPIPE, - это читатель закончил раньше (например pg_restore упал и ошибки игнорируются),
+        а не испорченный бэкап. Результат тогда определяет читатель
+        """
+        if process.stdin:
+            process.stdin.close()
+        try:
+            process.wait(timeout)
+        except subprocess.TimeoutExpired as e:
+            process.kill()
+            raise e
+        if process.returncode == -signal.SIGPIPE:
+            log.debug('Process %s stopped: reader closed the pipe', process.args[0])
+            return
+        if process.returncode != 0:
+            raise RuntimeError('Backup compression process failed with code %s' % process.returncode)
+
+    @staticmethod
+    def peek(path, size):
+        """
+        Первые size байт распакованного содержимого. Нужно для определения формата сжатого бэкапа
+        """
+        process = Compression.start_decompressor(path)
+        try:
+            return process.stdout.read(size)
+        finally:
+            process.kill()
+            process.wait()
+            process.stdout.close()
@@ -16,7 +16,10 @@ class DBTools(object):
     def create(self):
         raise NotImplementedError
 
-    def restore(self):
+    def restore(self, reduced=False):
+        """
+        :param reduced: восстановить базу сразу уменьшенной, как после reduce
+        """
         raise NotImplementedError
 
     def backup(self):
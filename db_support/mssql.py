@@ -1,9 +1,11 @@
 import logging
 import pymssql
 import time
-from threading import Timer
+from threading import Lock
 
+import metrics
 from db_support.db_tools import DBTools
+from db_support.mssql_purge import DatabaseFilePurge, GhostCleanupWait
 
 log = logging.getLogger('[test tools mssql]')
 
@@ -11,39 +13,142 @@ log = logging.getLogger('[test tools mssql]')
 class Mssql(DBTools):
     DB_TYPE = "mssql"
 
+    LOGIN_TIMEOUT = 60
+    # Сколько простаивающих соединений держать для одной базы
+    POOL_SIZE = 2
+    # Соединение, простаивавшее дольше, перед использованием проверяется
+    HEALTH_CHECK_INTERVAL = 30
+    # Коды ошибок db-lib, после которых соединение мертво: ошибка записи/чтения, соединение закрыто, DBPROCESS мертв.
+    # Таймаут запроса (20003) сюда не входит, долгий запрос повторять нельзя
+    CONNECTION_ERRORS = (20006, 20009, 20017, 20047)
+
     def __init__(self, db_config):
         super(Mssql, self).__init__(db_config)
         self.db_files_dir = db_config.mssql_db_dir
         self.backup_path = '{}\\{}.bak'.format(db_config.backup_dir, self.name)
+        # из переменных среды приходят строки
+        self.backup_compression = str(db_config.mssql_backup_compression).lower() in ('true', '1')
+        self.backup_buffer_count = db_config.mssql_backup_buffer_count
+        self.backup_max_transfer_size = db_config.mssql_backup_max_transfer_size
+        stripes = max(int(db_config.mssql_backup_stripes), 1)
+        if stripes == 1:
+            self.backup_files = [self.backup_path]
+        else:
+            backup_dirs = [d.strip() for d in (db_config.mssql_backup_dirs or db_config.backup_dir).split(',')]
+            self.backup_files = ['{}\\{}_{}of{}.bak'.format(backup_dirs[i % len(backup_dirs)], self.name, i + 1, stripes)
+                                 for i in range(stripes)]
         self.port = int(self.port)
+        # простаивающие соединения по (база, таймаут запроса), None вместо базы - master
+        self._pool = {}
+        self._pool_lock = Lock()
+        # {(файлы набора, BackupSetGUID): (заголовок, список файлов)}
+        self._backup_metadata = {}
 
-    def _run_sql(self, sql, timeout, connect_to_current_db=True, non_query=True, ignore_errors=False):
-        log.debug('Run sql. Server %s, timeout %s, query %s', self.addr, timeout, sql)
-
+    def _connect(self, database, timeout):
         kw = {'server': self.addr,
               'user': self.user,
               'password': self.password,
               'port': self.port,
-              'timeout': timeout}
-        if connect_to_current_db:
-            kw['database'] = self.name
+              'timeout': timeout,
+              'login_timeout': self.LOGIN_TIMEOUT}
+        if database:
+            kw['database'] = database
+        conn = pymssql.connect(**kw)
+        conn.autocommit(True)
+        return conn
+
+    def _get_connection(self, database, timeout):
+        """
+        Соединение из пула. Таймаут запроса задается при подключении, поэтому пул отдельный на каждый таймаут.
+        Долго простаивавшее соединение перед выдачей проверяется, мертвое заменяется новым
+        :return: (соединение, взято ли оно из пула)
+        """
+        with self._pool_lock:
+            idle = self._pool.setdefault((database, timeout), [])
+            conn, last_used = idle.pop() if idle else (None, 0)
+
+        if conn is not None and time.time() - last_used > self.HEALTH_CHECK_INTERVAL:
+            try:
+                conn.cursor().execute('SELECT 1')
+            except pymssql.Error as e:
+                log.debug('Connection to %s is broken, reconnect: %s', database or 'master', e)
+                self._close_quietly(conn)
+                conn = None
+
+        if conn is not None:
+            return conn, True
+        return self._connect(database, timeout), False
+
+    def _put_connection(self, database, timeout, conn):
+        with self._pool_lock:
+            idle = self._pool.setdefault((database, timeout), [])
+            if len(idle) < self.POOL_SIZE:
+                idle.append((conn, time.time()))
+                return
+        self._close_quietly(conn)
+
+    def _close_connections(self, database):
+        """
+        Закрывает простаивающие соединения с базой. Нужно перед операциями, требующими монопольного доступа
+        """
+        with self._pool_lock:
+            keys = [key for key in self._pool if key[0] == database]
+            idle = [item for key in keys for item in self._pool.pop(key)]
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    @classmethod
+    def _is_connection_error(cls, e):
+        if isinstance(e, pymssql.InterfaceError):
+            return True
+        return isinstance(e, pymssql.OperationalError) and bool(e.args) and e.args[0] in cls.CONNECTION_ERRORS
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except pymssql.Error:
+            pass
+
+    def _run_sql(self, sql, timeout, connect_to_current_db=True, non_query=True, ignore_errors=False, as_dict=False):
+        log.debug('Run sql. Server %s, timeout %s, query %s', self.addr, timeout, sql)
 
-        with pymssql.connect(**kw) as conn:
-            conn.autocommit(True)
-            cursor = conn.cursor()
+        database = self.name if connect_to_current_db else None
+        attempt = 0
+        while True:
+            attempt += 1
+            conn, pooled = self._get_connection(database, timeout)
             try:
+                cursor = conn.cursor(as_dict=as_dict)
                 cursor.execute(sql)
+                if not non_query:
+                    l = cursor.fetchall()
+                    log.debug('Result: %s', l)
+                else:
+                    l = cursor.rowcount
+                break
             except pymssql.Error as e:
+                # после ошибки состояние соединения неизвестно, в пул его не возвращаем
+                self._close_quietly(conn)
+                # соединение из пула могло умереть, пока простаивало. Запрос на нем не выполнился, повторяем
+                if pooled and attempt == 1 and self._is_connection_error(e):
+                    log.debug('Connection to %s is broken, retry on new connection: %s', database or 'master', e)
+                    continue
                 if ignore_errors:
+                    # у упавшего запроса результата нет
                     log.warning(str(e))
-                else:
-                    raise e
-            if not non_query:
-                l = cursor.fetchall()
-                log.debug('Result: %s', l)
-                return l
-            else:
-                return cursor.rowcount
+                    return None
+                raise e
+            except Exception as e:
+                self._close_quietly(conn)
+                raise e
+
+        # use в запросе переключает базу соединения, возвращаем в пул только соединения, оставшиеся в своей базе
+        if sql.lstrip().lower().startswith('use ') and not connect_to_current_db:
+            self._close_quietly(conn)
+        else:
+            self._put_connection(database, timeout, conn)
+        return l
 
     def create(self):
         log.info('Create database %s on server %s', self.name, self.addr)
@@ -56,30 +161,69 @@ class Mssql(DBTools):
         self._run_sql('ALTER DATABASE {} SET ALLOW_SNAPSHOT_ISOLATION ON;'.format(self.name),
                       timeout=self.quick_operation_timeout)
 
+    def _backup_devices(self):
+        """
+        Список файлов набора бэкапа для FROM/TO
+        """
+        return ', '.join('DISK = \'{}\''.format(f) for f in self.backup_files)
+
+    def _transfer_options(self):
+        options = []
+        if self.backup_buffer_count:
+            options.append('BUFFERCOUNT = {}'.format(int(self.backup_buffer_count)))
+        if self.backup_max_transfer_size:
+            options.append('MAXTRANSFERSIZE = {}'.format(int(self.backup_max_transfer_size)))
+        return options
+
     def backup(self):
         log.info('Backup database %s on server %s', self.name, self.addr)
-        sql = 'BACKUP DATABASE {} TO DISK = \'{}\' WITH INIT'.format(self.name,
-                                                                     self.backup_path)
-        self._run_sql(sql, timeout=self.backup_timeout)
+        # FORMAT - перезаписать заголовки, иначе файлы из старого набора с другим числом частей не перезапишутся
+        options = ['INIT', 'FORMAT']
+        if self.backup_compression:
+            options.append('COMPRESSION')
+        options.extend(self._transfer_options())
+        sql = 'BACKUP DATABASE {} TO {} WITH {}'.format(self.name,
+                                                       self._backup_devices(),
+                                                       ', '.join(options))
+        with metrics.span('backup database'):
+            self._run_sql(sql, timeout=self.backup_timeout)
+        self._backup_metadata.clear()
+
+    def _read_backup_metadata(self):
+        """
+        Заголовок и список файлов набора бэкапа. RESTORE HEADERONLY читает только заголовок, а долгий на больших
+        бэкапах FILELISTONLY выполняется один раз для каждого набора, пока BackupSetGUID не изменится
+        :return: (заголовок как dict, список файлов из FILELISTONLY)
+        """
+        devices = self._backup_devices()
+        header = self._run_sql('RESTORE HEADERONLY FROM {}'.format(devices), timeout=self.quick_operation_timeout,
+                               non_query=False, connect_to_current_db=False, as_dict=True)[0]
+        key = (devices, str(header['BackupSetGUID']))
+        if key not in self._backup_metadata:
+            file_list = self._run_sql('RESTORE FILELISTONLY FROM {}'.format(devices),
+                                      timeout=self.quick_operation_timeout, non_query=False,
+                                      connect_to_current_db=False)
+            # старые наборы больше не понадобятся
+            self._backup_metadata.clear()
+            self._backup_metadata[key] = (header, file_list)
+        else:
+            log.debug('Use cached file list of backup set %s', key[1])
+        return self._backup_metadata[key]
 
     def has_default_backup(self):
         log.debug("has default backup checking")
-        sql = 'RESTORE FILELISTONLY FROM DISK = \'{}\''.format(self.backup_path)
         try:
-            self._run_sql(sql, timeout=self.quick_operation_timeout, non_query=False,
-                          connect_to_current_db=False)
+            self._read_backup_metadata()
         except pymssql.DatabaseError:
             log.info("Default backup not found")
             return False
 
         return True
 
-    def restore(self):
+    def restore(self, reduced=False):
         log.info('Restore database %s on server %s', self.name, self.addr)
         # Сначала узнаем какие файлы содержит бэкапю Возвращает таблицу
-        sql = 'RESTORE FILELISTONLY FROM DISK = \'{}\''.format(self.backup_path)
-        file_list = self._run_sql(sql, timeout=self.quick_operation_timeout, non_query=False,
-                                  connect_to_current_db=False)
+        header, file_list = self._read_backup_metadata()
 
         # Формируем скл запрос, который содержит правильные пути до файлов базы данных
         sql_part = []
@@ -91,11 +235,15 @@ class Mssql(DBTools):
                                                 ('LDF' if elem[2] == 'L' else 'MDF'))  # L или D. Лог или данные
 
             sql_part.append('MOVE \'{}\' TO \'{}\''.format(elem[0], new_filename))  # логическое имя
-        sql = 'RESTORE DATABASE {} FROM DISK = \'{}\' WITH RECOVERY, REPLACE, {};' \
+        sql = 'RESTORE DATABASE {} FROM {} WITH RECOVERY, REPLACE, {};' \
             .format(self.name,
-                    self.backup_path,
-                    ', '.join(sql_part))
-        self._run_sql(sql, self.restore_timeout, connect_to_current_db=False)
+                    self._backup_devices(),
+                    ', '.join(self._transfer_options() + sql_part))
+        # RESTORE требует монопольного доступа к базе, свои соединения с ней закрываем
+        self._close_connections(self.name)
+        with metrics.span('restore database'):
+            self._run_sql(sql, self.restore_timeout, connect_to_current_db=False)
+        metrics.inc('test_tools_bytes_total', int(header.get('BackupSize') or 0), operation='mssql_restore')
 
         # Изменить логические имена на новое имя базы данных. Если это файл лога, то добавить log, иначе номер файла
         # Нужно для шринка и очистки и чтобы не было одинаковых логических имен, что потенциально может давать глюки
@@ -109,6 +257,10 @@ class Mssql(DBTools):
                                                                                                  good_name),
                         timeout=self.quick_operation_timeout)
 
+        # бэкап mssql выборочно не восстановить
+        if reduced:
+            self.reduce()
+
     def customer_patch(self):
         log.debug('Выполнение sql специфичных для базы ДВФУ (fefu)')
         # Чистим 60+ ГБ
@@ -169,47 +321,29 @@ class Mssql(DBTools):
                       timeout=self.quick_operation_timeout, ignore_errors=True)
 
         # Удаляем файлы, хранящиеся в базе данных. Mssql пылесос блобов работает в фоне,
-        # поэтому удаляем серией маленьких транзакций по 500 файлов
-
-        def timeout_err():
-            log.error('Timeout while removing database files. Stop operation')
-
-        t = Timer(self.restore_timeout, timeout_err)
-        t.start()
-        while not t.finished.is_set():
-            if self._run_sql(
-                    'use {}; update top(1000) databasefile_t set content_p = null where content_p is not null and '
-                    '(filename_p not in (\'platform-variables.less\', \'platform.css\', \'shared.css\') '
-                    'or filename_p is null);'.format(self.name),
-                    timeout=self.middle_operation_timeout, ignore_errors=True, non_query=True) == 0:
-                t.cancel()
-                break
+        # поэтому удаляем серией маленьких транзакций по диапазонам первичного ключа
+        with metrics.span('database file purge'):
+            DatabaseFilePurge(self).run(self.restore_timeout)
 
         # Ждем пока пылесос подчистит оставшееся, если мы начнем шринкать до этого момента,
         # то пылесосить дальше он будет после шринка, что приведет к тому что база будет ужата не полностью
-        size_before = 999999999
-        while 1:
-            table_row = self._run_sql('sp_spaceused DATABASEFILE_T;'.format(self.name),
-                                      ignore_errors=False, non_query=False, timeout=self.quick_operation_timeout)[0]
-            # третья строка содержит размер данных таблицы,в виде строки, убираю ' KB' чтобы получить число
-            size_at_moment = int(table_row[3][:-3])
-            if size_at_moment == size_before:
-                break
-            else:
-                size_before = size_at_moment
-                time.sleep(60)
+        with metrics.span('ghost cleanup wait'):
+            GhostCleanupWait(self).run(self.restore_timeout)
 
         # Еще раз удаляем лог транзакций после операции update
-        self._run_sql('use {name}; DBCC SHRINKFILE ({name}_log, 1);'.format(name=self.name),
-                      timeout=self.middle_operation_timeout, ignore_errors=True)
+        with metrics.span('shrink log after purge'):
+            self._run_sql('use {name}; DBCC SHRINKFILE ({name}_log, 1);'.format(name=self.name),
+                          timeout=self.middle_operation_timeout, ignore_errors=True)
 
         # Уменьшаем базу, освобождаем место на диске. Оставляем 5% свободного места
-        self._run_sql('DBCC SHRINKDATABASE ({}, 5);'.format(self.name),
-                      timeout=self.restore_timeout, ignore_errors=False)
+        with metrics.span('shrink database'):
+            self._run_sql('DBCC SHRINKDATABASE ({}, 5);'.format(self.name),
+                          timeout=self.restore_timeout, ignore_errors=False)
 
         # Еще раз удаляем лог транзакций последний операций
-        self._run_sql('use {name}; DBCC SHRINKFILE ({name}_log, 1);'.format(name=self.name),
-                      timeout=self.middle_operation_timeout, ignore_errors=True)
+        with metrics.span('shrink log after shrink database'):
+            self._run_sql('use {name}; DBCC SHRINKFILE ({name}_log, 1);'.format(name=self.name),
+                          timeout=self.middle_operation_timeout, ignore_errors=True)
 
         # Включаем полноценный лог транзакций
         self._run_sql('ALTER DATABASE {} SET RECOVERY FULL; '.format(self.name),
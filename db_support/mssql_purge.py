@@ -0,0 +1,172 @@
+import logging
+import time
+
+log = logging.getLogger('[test tools mssql]')
+
+
+class DatabaseFilePurge(object):
+    """
+    Удаление содержимого файлов из databasefile_t пачками по первичному ключу (keyset): граница следующей пачки -
+    id, до которого в таблице ровно batch строк. Число запросов зависит от числа строк, а не от разброса id.
+    Каждый запрос читает только свой диапазон, а не сканирует таблицу заново в поисках непустых content_p.
+    Размер пачки подстраивается так, чтобы запрос выполнялся около TARGET_BATCH_SECONDS,
+    и уменьшается если лог транзакций заполняется быстрее, чем сервер его освобождает или запрос упал
+    """
+    TARGET_BATCH_SECONDS = 5
+    MIN_BATCH = 100
+    MAX_BATCH = 1000000
+    START_BATCH = 1000
+    # при заполнении лога выше этого процента уменьшаем пачку и делаем checkpoint, чтобы лог обрезался
+    LOG_USED_PERCENT_LIMIT = 60
+    PROGRESS_INTERVAL = 30
+
+    def __init__(self, db):
+        """
+        :param db: база данных Mssql
+        """
+        self.db = db
+
+    def _scalar(self, sql):
+        rows = self.db._run_sql('use {}; {}'.format(self.db.name, sql), non_query=False,
+                                timeout=self.db.quick_operation_timeout, ignore_errors=True)
+        return rows[0][0] if rows else None
+
+    def _log_used_percent(self):
+        # sys.dm_db_log_space_usage есть начиная с SQL Server 2012, на старых просто не следим за логом
+        try:
+            return self._scalar('select used_log_space_in_percent from sys.dm_db_log_space_usage;')
+        except Exception:
+            return None
+
+    def _next_boundary(self, last_id, batch):
+        """
+        :return: id, до которого (включительно) после last_id лежит batch строк, None если строк больше нет
+        """
+        return self.db._run_sql('use {}; select max(id) from (select top ({}) id from databasefile_t '
+                                'where id > {} order by id) t;'.format(self.db.name, batch, last_id),
+                                non_query=False, timeout=self.db.quick_operation_timeout)[0][0]
+
+    def run(self, timeout):
+        min_id = self.db._run_sql('use {}; select min(id) from databasefile_t;'.format(self.db.name),
+                                  non_query=False, timeout=self.db.quick_operation_timeout)[0][0]
+        if min_id is None:
+            log.info('databasefile_t is empty')
+            return
+        # считаем только строки, которые еще надо чистить
+        to_purge = self._scalar('select count(*) from databasefile_t where content_p is not null;') or 0
+
+        log.info('Purge databasefile_t content, about %s rows with content', to_purge)
+        started = time.time()
+        deadline = started + timeout
+        last_progress = started
+        purged = 0
+        batch = self.START_BATCH
+        last_id = min_id - 1
+        while True:
+            if time.time() > deadline:
+                log.error('Timeout while removing database files. Stop operation')
+                return
+
+            batch_started = time.time()
+            boundary = self._next_boundary(last_id, batch)
+            if boundary is None:
+                break
+            rowcount = self.db._run_sql(
+                    'use {}; update databasefile_t set content_p = null '
+                    'where id > {} and id <= {} and content_p is not null and '
+                    '(filename_p not in (\'platform-variables.less\', \'platform.css\', \'shared.css\') '
+                    'or filename_p is null);'.format(self.db.name, last_id, boundary),
+                    timeout=self.db.middle_operation_timeout, ignore_errors=True, non_query=True)
+            elapsed = time.time() - batch_started
+            if rowcount is None:
+                # запрос упал (например по таймауту), диапазон не очищен. Повторяем его меньшей пачкой
+                if batch <= self.MIN_BATCH:
+                    raise RuntimeError('Cannot purge databasefile_t rows with id from {} to {}'
+                                       .format(last_id + 1, boundary))
+                batch = max(batch // 2, self.MIN_BATCH)
+                log.warning('Purge of databasefile_t rows after id %s failed, retry with batch %s', last_id, batch)
+                continue
+            purged += max(rowcount, 0)
+            last_id = boundary
+
+            # подгоняем размер пачки под целевое время запроса, но не больше чем в 2 раза за шаг
+            factor = min(max(self.TARGET_BATCH_SECONDS / max(elapsed, 0.01), 0.5), 2)
+            batch = int(batch * factor)
+
+            log_used = self._log_used_percent()
+            if log_used is not None and log_used > self.LOG_USED_PERCENT_LIMIT:
+                log.debug('Transaction log used %s%%, reduce batch and checkpoint', log_used)
+                batch //= 2
+                self.db._run_sql('use {}; checkpoint;'.format(self.db.name),
+                                 timeout=self.db.middle_operation_timeout, ignore_errors=True)
+            batch = min(max(batch, self.MIN_BATCH), self.MAX_BATCH)
+
+            now = time.time()
+            if now - last_progress > self.PROGRESS_INTERVAL:
+                last_progress = now
+                log.info('Purge databasefile_t: %s rows cleared, %.0f rows/sec, about %s rows remaining, '
+                         'batch %s rows, last id %s',
+                         purged, purged / (now - started), max(to_purge - purged, 0), batch, last_id)
+
+        log.info('Purge databasefile_t finished: %s rows cleared in %.0f sec', purged, time.time() - started)
+
+
+class GhostCleanupWait(object):
+    """
+    Ожидание фоновой очистки databasefile_t после удаления содержимого файлов.
+    Смотрит на количество занятых страниц таблицы в sys.dm_db_partition_stats и на количество ghost записей.
+    Пока страницы освобождаются опрашиваем часто, когда перестали - интервал растет.
+    Очистка закончена, когда страниц не становится меньше и ghost записей не осталось
+    """
+    MIN_INTERVAL = 2
+    MAX_INTERVAL = 60
+    # сколько раз подряд размер должен не измениться, чтобы проверить ghost записи
+    STABLE_CHECKS = 3
+
+    def __init__(self, db):
+        """
+        :param db: база данных Mssql
+        """
+        self.db = db
+
+    def _used_pages(self):
+        return self.db._run_sql('use {}; select sum(used_page_count) from sys.dm_db_partition_stats '
+                                'where object_id = object_id(\'databasefile_t\');'.format(self.db.name),
+                                non_query=False, timeout=self.db.quick_operation_timeout)[0][0] or 0
+
+    def _ghost_records(self):
+        # SAMPLED читает только часть страниц, LIMITED ghost записи не считает
+        rows = self.db._run_sql('use {}; select sum(ghost_record_count) from sys.dm_db_index_physical_stats('
+                                'db_id(), object_id(\'databasefile_t\'), null, null, \'SAMPLED\');'
+                                .format(self.db.name),
+                                non_query=False, timeout=self.db.middle_operation_timeout, ignore_errors=True)
+        return rows[0][0] or 0 if rows else 0
+
+    def run(self, timeout):
+        started = time.time()
+        deadline = started + timeout
+        interval = self.MIN_INTERVAL
+        stable = 0
+        pages = self._used_pages()
+        log.info('Wait ghost cleanup of databasefile_t, %s pages used', pages)
+        while time.time() < deadline:
+            time.sleep(interval)
+            pages_at_moment = self._used_pages()
+            if pages_at_moment < pages:
+                # очистка идет, следим часто
+                pages = pages_at_moment
+                stable = 0
+                interval = self.MIN_INTERVAL
+                continue
+
+            stable += 1
+            interval = min(interval * 2, self.MAX_INTERVAL)
+            if stable >= self.STABLE_CHECKS:
+                ghosts = self._ghost_records()
+                if not ghosts:
+                    log.info('Ghost cleanup finished in %.0f sec, %s pages used', time.time() - started, pages)
+                    return
+                log.debug('%s ghost records left', ghosts)
+                stable = 0
+
+        log.warning('Ghost cleanup is not finished in %s sec, continue', timeout)
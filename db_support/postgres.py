@@ -1,10 +1,17 @@
 import logging
 import os
-import subprocess
+import re
+import shutil
+from contextlib import contextmanager
 
 import magic
 
+import metrics
+import process_runner
+from db_support.compression import Compression
 from db_support.db_tools import DBTools
+from db_support.postgres_sql import SqlExecutor
+from db_support.postgres_templates import TemplateCache
 
 log = logging.getLogger('[test tools postgres]')
 
@@ -12,15 +19,43 @@ log = logging.getLogger('[test tools postgres]')
 class Postgres(DBTools):
     DB_TYPE = "postgres"
 
+    PLAIN_FORMAT = 'plain'
+    CUSTOM_FORMAT = 'custom'
+    DIRECTORY_FORMAT = 'directory'
+    TAR_FORMAT = 'tar'
+
+    # Таблицы, хранящие печатные формы различных документов
+    PRINT_FORM_TABLES = ('studentextracttextrelation_t', 'studentordertextrelation_t', 'stdntothrordrtxtrltn_t',
+                         'employeeordertextrelation_t', 'employeeextracttextrelation_t', 'session_doc_printform_t',
+                         'session_att_bull_printform_t')
+    # Таблицы, данные которых не восстанавливаются при восстановлении с уменьшением. Все что очищает reduce.
+    # logeventproperty_t - самая большая из ссылающихся на logevent_t, ее данные просто не читаем. Остальные
+    # ссылающиеся таблицы очищаются после восстановления данных, как truncate logevent_t cascade в reduce
+    REDUCE_SKIP_DATA_TABLES = ('logevent_t', 'logeventproperty_t', 'nsientitylog_t') + PRINT_FORM_TABLES
+    REDUCE_CASCADE_TABLE = 'logevent_t'
+    # внешний ключ в sql post-data секции бэкапа: ALTER TABLE ONLY public.a_t ADD CONSTRAINT ... REFERENCES public.b_t(id)
+    FOREIGN_KEY_RE = re.compile(r'ALTER TABLE ONLY (\S+)\s+ADD CONSTRAINT \S+ FOREIGN KEY \([^)]*\) REFERENCES ([^\s(]+)\(')
+
     def __init__(self, db_config):
         super(Postgres, self).__init__(db_config)
         self.ignore_restore_errors = db_config.postgres_ignore_restore_errors
+        # из переменных среды приходит строка
+        self.jobs = max(int(db_config.postgres_jobs), 1)
+        self.console_log_dir = db_config.console_log_dir
+        os.makedirs(self.console_log_dir, exist_ok=True)
+        self.compression = Compression(db_config.backup_compression, db_config.backup_compression_level)
 
         if not os.path.exists(db_config.backup_dir):
             os.mkdir(db_config.backup_dir)
         self.backup_path = os.path.join(db_config.backup_dir, 'default.backup')
+        self.sql = SqlExecutor(self, db_config.postgres_pool_size)
+        self.templates = TemplateCache(self, db_config.postgres_templates, db_config.postgres_templates_max_size_gb)
 
-    def _run_console_command(self, args, timeout, ignore_error=False, stdin=None):
+    def _run_console_command(self, args, timeout, ignore_error=False, stdin=None, stdout=None, capture=False):
+        """
+        :param stdout: куда перенаправить stdout, по умолчанию он вместе с stderr идет в лог команды
+        :param capture: вернуть stdout
+        """
         common = [
             '--host', self.addr,
             '--username', self.user,
@@ -33,152 +68,337 @@ class Postgres(DBTools):
 
         log.debug('Run process with command: %s', ' '.join(args))
         os.putenv('PGPASSWORD', self.password)
-        process = subprocess.Popen(args=args,
-                                   stderr=subprocess.PIPE, stdout=subprocess.PIPE, stdin=stdin)
-        try:
-            out, err = process.communicate(timeout=timeout)
-        except subprocess.TimeoutExpired as e:
-            process.kill()
-            raise e
+        # весь вывод в файле, в памяти только последние строки
+        log_path = os.path.join(self.console_log_dir, args[0] + '.log')
+        result = process_runner.run(args, timeout, stdin=stdin, stdout=stdout, capture=capture, log_path=log_path)
 
-        if process.returncode != 0:
+        if result.returncode != 0:
             log.debug(' '.join(args))
-            # Чтобы ошибки восстановления не засирали лог вывводим первые 1000 символов
-            error_text = out.decode() + err.decode()
-            if len(error_text) < 1000:
-                log.debug(error_text)
-            else:
-                log.debug('{} \n and another {} symbols'.format(error_text[-1000:], len(error_text) - 1000))
+            # Чтобы ошибки восстановления не засирали лог выводим последние строки
+            log.debug('\n'.join(result.tail))
             if not ignore_error:
-                raise RuntimeError('Console command for postgresql failed. See log for details')
+                raise RuntimeError('Console command for postgresql failed. See {} for details'.format(log_path))
+        return result.out
 
     def create(self):
         log.info('Create database %s on server %s', self.name, self.addr)
-        args = ['psql',
-                '--command', 'CREATE DATABASE {0}'.format(self.name),
-                ]
-        self._run_console_command(args, timeout=self.quick_operation_timeout)
+        with metrics.span('create database'):
+            self.sql.execute('CREATE DATABASE {0}'.format(self.name), timeout=self.quick_operation_timeout)
 
     def drop(self):
         log.info('Drop database %s on server %s', self.name, self.addr)
-        self._run_console_command(['psql',
-                                   '--command', 'DROP DATABASE {0}'.format(self.name),
-                                   ], timeout=self.quick_operation_timeout)
+        # свои соединения с базой не дадут ее удалить
+        self.sql.close(self.name)
+        with metrics.span('drop database'):
+            self.sql.execute('DROP DATABASE {0}'.format(self.name), timeout=self.quick_operation_timeout)
 
     def backup(self):
         log.info('Backup database %s on server %s', self.name, self.addr)
-        args = ['pg_dump',
-                '--dbname', self.name,
-                '--format', 'c',
-                '--file', self.backup_path,
-                ]
-        self._run_console_command(args, self.backup_timeout)
+        # pg_dump пишет рядом, старый бэкап подменяется только после успешного завершения
+        if self.jobs > 1:
+            # Параллельный дамп возможен только в формате директории. Файлы таблиц в директории pg_dump сжимает сам
+            backup_path = self.backup_path
+            args = ['pg_dump',
+                    '--dbname', self.name,
+                    '--format', 'd',
+                    '--jobs', str(self.jobs),
+                    ]
+        elif self.compression.enabled:
+            # Несжатый архив идет в пайп, сжимает внешняя утилита. Своим zlib pg_dump не сжимает,
+            # чтобы не жать данные дважды
+            backup_path = self.compression.path(self.backup_path)
+            args = ['pg_dump',
+                    '--dbname', self.name,
+                    '--format', 'c',
+                    '--compress', '0',
+                    ]
+        else:
+            backup_path = self.backup_path
+            args = ['pg_dump',
+                    '--dbname', self.name,
+                    '--format', 'c',
+                    ]
+
+        tmp_path = backup_path + '.tmp'
+        self._remove_path(tmp_path)
+        try:
+            with metrics.span('pg_dump'):
+                self._dump(args, tmp_path)
+        except Exception as e:
+            self._remove_path(tmp_path)
+            raise e
+
+        metrics.inc('test_tools_bytes_total', self._path_size(tmp_path), operation='postgres_backup')
+        self._remove_path(backup_path)
+        os.rename(tmp_path, backup_path)
+        self.compression.remove_stale(self.backup_path, backup_path)
+
+    def _dump(self, args, tmp_path):
+        if self.jobs == 1 and self.compression.enabled:
+            with open(tmp_path, 'wb') as f:
+                compressor = self.compression.start_compressor(f)
+                try:
+                    self._run_console_command(args, self.backup_timeout, stdout=compressor.stdin)
+                except Exception as e:
+                    compressor.kill()
+                    compressor.wait()
+                    raise e
+                Compression.finish(compressor, self.quick_operation_timeout)
+        else:
+            args.extend(['--file', tmp_path])
+            self._run_console_command(args, self.backup_timeout)
+
+    @staticmethod
+    def _path_size(path):
+        if not os.path.isdir(path):
+            return os.path.getsize(path)
+        return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+    @staticmethod
+    def _remove_path(path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    @contextmanager
+    def _backup_stream(self, backup_path, partial=False):
+        """
+        Бинарный поток с содержимым файла бэкапа. Сжатый бэкап распаковывается на лету
+        :param partial: читатель прочитает не все, например pg_restore --list читает только оглавление.
+        Распаковка тогда останавливается без проверки кода возврата
+        """
+        if not Compression.is_compressed(backup_path):
+            with open(backup_path, 'rb') as f:
+                yield f
+            return
+
+        decompressor = Compression.start_decompressor(backup_path)
+        try:
+            yield decompressor.stdout
+        except Exception as e:
+            decompressor.kill()
+            decompressor.wait()
+            raise e
+        finally:
+            decompressor.stdout.close()
+        if partial:
+            decompressor.kill()
+            decompressor.wait()
+            return
+        Compression.finish(decompressor, self.quick_operation_timeout)
+
+    @staticmethod
+    def _backup_format(backup_path):
+        if os.path.isdir(backup_path):
+            return Postgres.DIRECTORY_FORMAT
+
+        if Compression.is_compressed(backup_path):
+            # сжатый бэкап узнаем по сигнатуре распакованного начала файла
+            head = Compression.peek(backup_path, 512)
+            if head.startswith(b'PGDMP'):
+                return Postgres.CUSTOM_FORMAT
+            if head[257:262] == b'ustar':
+                return Postgres.TAR_FORMAT
+            return Postgres.PLAIN_FORMAT
+
+        file_type = magic.from_file(backup_path, mime=False)
+        if file_type.find('ASCII text') != -1:
+            return Postgres.PLAIN_FORMAT
+        if file_type.find('PostgreSQL') != -1:
+            return Postgres.CUSTOM_FORMAT
+        if file_type.find('POSIX tar archive') != -1:
+            return Postgres.TAR_FORMAT
+
+        log.error('File type of backup %s', file_type)
+        raise RuntimeError('Wrong postgres backup format')
 
     def has_default_backup(self):
         log.debug("has default backup checking")
-        if not os.path.exists(self.backup_path):
+        if self.compression.existing_path(self.backup_path) is None:
             log.info("Default backup not found")
             return False
         return True
 
-    def restore(self):
+    def restore(self, reduced=False):
         log.info('Restore database %s on server %s', self.name, self.addr)
-        if not os.path.isdir(self.backup_path) and magic.from_file(self.backup_path, mime=False).find(
-                'ASCII text') != -1:
+        backup_path = self.compression.existing_path(self.backup_path) or self.backup_path
+        if not self.templates.enabled:
+            self._restore_backup(backup_path, reduced)
+            return
+
+        template = self.templates.template_name(backup_path, reduced)
+        if self.templates.exists(template):
             # Чтобы наследники юзали методы родителя
             Postgres.drop(self)
-            Postgres.create(self)
+            with metrics.span('template restore'):
+                self.templates.restore(template)
+            return
+
+        self._restore_backup(backup_path, reduced)
+        # свои соединения с базой не дадут скопировать ее шаблоном
+        self.sql.close(self.name)
+        # база уже восстановлена, без шаблона просто не будет ускорения в следующий раз
+        try:
+            with metrics.span('template save'):
+                self.templates.save(template)
+        except Exception as e:
+            log.warning('Cannot save template %s: %s', template, e)
+
+    def _restore_backup(self, backup_path, reduced):
+        backup_format = self._backup_format(backup_path)
+        compressed = Compression.is_compressed(backup_path)
+
+        # Чтобы наследники юзали методы родителя
+        Postgres.drop(self)
+        Postgres.create(self)
+        metrics.inc('test_tools_bytes_total', self._path_size(backup_path), operation='postgres_restore')
+
+        if backup_format == self.PLAIN_FORMAT:
             log.info('Restore plain text backup to database %s on server %s', self.name, self.addr)
-            with open(self.backup_path) as f:
+            with self._backup_stream(backup_path) as f:
                 args = ['psql', '--quiet',
                         '--dbname', self.name,
                         ]
-                if self.ignore_restore_errors:
-                    self._run_console_command(args, self.restore_timeout, ignore_error=True, stdin=f)
-                else:
-                    self._run_console_command(args, self.restore_timeout, ignore_error=False, stdin=f)
-
-        elif os.path.isdir(self.backup_path) \
-                or magic.from_file(self.backup_path, mime=False).find('PostgreSQL') != -1 \
-                or magic.from_file(self.backup_path, mime=False).find('POSIX tar archive') != -1:
-            Postgres.drop(self)
-            Postgres.create(self)
-            log.info('Restore pg_dump backup to database %s on server %s', self.name, self.addr)
-            args = ['pg_restore',
-                    '--no-owner', '--no-privileges',
-                    '--dbname', self.name,
-                    self.backup_path,
-                    ]
+                with metrics.span('psql'):
+                    if self.ignore_restore_errors:
+                        self._run_console_command(args, self.restore_timeout, ignore_error=True, stdin=f)
+                    else:
+                        self._run_console_command(args, self.restore_timeout, ignore_error=False, stdin=f)
+            # из текстового бэкапа выборочно не восстановить
+            if reduced:
+                Postgres.reduce(self)
+            return
 
-            if self.ignore_restore_errors:
-                self._run_console_command(args, self.restore_timeout, ignore_error=True)
-            else:
-                args.insert(-1, '--exit-on-error')
-                self._run_console_command(args, self.restore_timeout, ignore_error=False)
-        else:
-            log.error('File type of backup %s', magic.from_file(self.backup_path, mime=False))
-            raise RuntimeError('Wrong postgres backup format')
+        log.info('Restore pg_dump backup to database %s on server %s', self.name, self.addr)
+        args = ['pg_restore',
+                '--no-owner', '--no-privileges',
+                '--dbname', self.name,
+                ]
+        # tar формат и поток из пайпа pg_restore параллельно восстанавливать не умеет
+        if self.jobs > 1 and not compressed and backup_format != self.TAR_FORMAT:
+            args.extend(['--jobs', str(self.jobs)])
+        if not self.ignore_restore_errors:
+            args.append('--exit-on-error')
+
+        if not reduced:
+            with metrics.span('pg_restore'):
+                self._pg_restore(args, backup_path, self.restore_timeout, self.ignore_restore_errors)
+            return
+
+        # По секциям: внешние ключи создаются в post-data, до этого очищаем все, что ссылается на logevent_t.
+        # Иначе ключи на пропущенные строки не создадутся, а с игнорированием ошибок молча пропадут
+        list_path = self._write_reduced_restore_list(backup_path)
+        try:
+            with metrics.span('pg_restore'):
+                self._pg_restore(args + ['--section', 'pre-data', '--section', 'data', '--use-list', list_path],
+                                 backup_path, self.restore_timeout, self.ignore_restore_errors)
+        finally:
+            os.remove(list_path)
+        with metrics.span('truncate'):
+            self._truncate_cascade(self.REDUCE_CASCADE_TABLE, backup_path)
+        with metrics.span('pg_restore post-data'):
+            self._pg_restore(args + ['--section', 'post-data'], backup_path, self.restore_timeout,
+                             self.ignore_restore_errors)
+
+        # Колонку из оглавления не выкинуть, поэтому файлы чистим уже после восстановления, но только в одной таблице
+        with metrics.span('clear database files'):
+            self._clear_database_files()
+            self.sql.execute('vacuum full databasefile_t;', timeout=self.restore_timeout, dbname=self.name)
+
+    def _write_reduced_restore_list(self, backup_path):
+        """
+        Пишет оглавление бэкапа для pg_restore --use-list без данных таблиц, которые очищает reduce
+        :return: путь к файлу оглавления
+        """
+        toc = self._pg_restore(['pg_restore', '--list'], backup_path, self.middle_operation_timeout,
+                               ignore_error=False, capture=True, partial=True)
+
+        skip_tables = set(self.REDUCE_SKIP_DATA_TABLES)
+        lines = []
+        skipped = 0
+        for line in toc.decode().splitlines():
+            # строка оглавления: "3456; 0 16385 TABLE DATA public logevent_t postgres"
+            match = re.match(r'^\d+; \d+ \d+ TABLE DATA \S+ (\S+) ', line)
+            if match and match.group(1).lower() in skip_tables:
+                line = ';' + line
+                skipped += 1
+            lines.append(line)
+        log.info('Skip data of %s tables in reduced restore', skipped)
+
+        list_path = os.path.join(os.path.dirname(self.backup_path), 'reduced_restore.list')
+        with open(list_path, 'wt') as f:
+            f.write('\n'.join(lines))
+        return list_path
+
+    def _pg_restore(self, args, backup_path, timeout, ignore_error, capture=False, partial=False):
+        """
+        Запускает pg_restore для файла бэкапа. Сжатый бэкап распаковывается в stdin
+        :param partial: pg_restore прочитает не весь архив, см. _backup_stream
+        """
+        if Compression.is_compressed(backup_path):
+            # без имени файла pg_restore читает архив из stdin
+            with self._backup_stream(backup_path, partial=partial) as f:
+                return self._run_console_command(list(args), timeout, ignore_error=ignore_error, stdin=f,
+                                                 capture=capture)
+        return self._run_console_command(args + [backup_path], timeout, ignore_error=ignore_error, capture=capture)
+
+    @staticmethod
+    def _table_name(name):
+        return name.split('.')[-1].strip('"').lower()
+
+    def _truncate_cascade(self, table, backup_path):
+        """
+        truncate table cascade до восстановления post-data. Внешних ключей в базе еще нет, поэтому ссылающиеся
+        таблицы (и ссылающиеся на них) берутся из определений ключей в бэкапе
+        """
+        ddl = self._pg_restore(['pg_restore', '--section', 'post-data'], backup_path, self.middle_operation_timeout,
+                               ignore_error=False, capture=True, partial=True)
+        referenced_by = {}
+        for match in self.FOREIGN_KEY_RE.finditer(ddl.decode()):
+            referenced_by.setdefault(self._table_name(match.group(2)), set()).add(self._table_name(match.group(1)))
+
+        tables = {table}
+        queue = [table]
+        while queue:
+            for referencing in referenced_by.get(queue.pop(), ()):
+                if referencing not in tables:
+                    tables.add(referencing)
+                    queue.append(referencing)
+        log.info('Truncate %s', ', '.join(sorted(tables)))
+        self.sql.execute('truncate {};'.format(', '.join(sorted(tables))), timeout=self.quick_operation_timeout,
+                         dbname=self.name)
+
+    def _clear_database_files(self):
+        self.sql.execute('update databasefile_t set content_p = null where content_p is not null and '
+                         '(filename_p is null '
+                         'or filename_p not in (\'platform-variables.less\', \'platform.css\', \'shared.css\'));',
+                         timeout=self.restore_timeout, dbname=self.name, ignore_error=True)
 
     def customer_patch(self):
         if self.name.find('pgups') != -1:
             log.info('Выполнение sql специфичных для базы ПГУПС (pgups)')
-            args = ['psql',
-                    '--dbname', self.name,
-                    '--command', 'update app_info_s set value_p=\'unipgups-web\'',
-                    ]
-            self._run_console_command(args, timeout=self.quick_operation_timeout, ignore_error=True)
+            self.sql.execute('update app_info_s set value_p=\'unipgups-web\'',
+                             timeout=self.quick_operation_timeout, dbname=self.name, ignore_error=True)
 
     def reduce(self):
         log.info('Reduce database %s on server %s', self.name, self.addr)
 
-        args = ['psql',
-                '--dbname', self.name,
-                '--command', 'truncate logevent_t cascade;',
-                ]
-        self._run_console_command(args, timeout=self.quick_operation_timeout)
+        with metrics.span('truncate'):
+            self.sql.execute('truncate logevent_t cascade;', timeout=self.quick_operation_timeout, dbname=self.name)
+            self.sql.execute('truncate nsientitylog_t;', timeout=self.quick_operation_timeout, dbname=self.name,
+                             ignore_error=True)
 
-        args = ['psql',
-                '--dbname', self.name,
-                '--command', 'truncate nsientitylog_t;',
-                ]
-        self._run_console_command(args, timeout=self.quick_operation_timeout, ignore_error=True)
-
-        # Удаляем содержимое таблиц, хранящих печатные формы различных документов, если они есть
-        self._run_console_command(['psql', '--dbname', self.name,
-                                   '--command', 'truncate table STUDENTEXTRACTTEXTRELATION_T;'.format(self.name)],
-                                  timeout=self.quick_operation_timeout, ignore_error=True)
-        self._run_console_command(['psql', '--dbname', self.name,
-                                   '--command', 'truncate table StudentOrderTextRelation_t;'.format(self.name)],
-                                  timeout=self.quick_operation_timeout, ignore_error=True)
-        self._run_console_command(['psql', '--dbname', self.name,
-                                   '--command', 'truncate table stdntothrordrtxtrltn_t;'.format(self.name)],
-                                  timeout=self.quick_operation_timeout, ignore_error=True)
-        self._run_console_command(['psql', '--dbname', self.name,
-                                   '--command', 'truncate table employeeordertextrelation_t;'.format(self.name)],
-                                  timeout=self.quick_operation_timeout, ignore_error=True)
-        self._run_console_command(['psql', '--dbname', self.name,
-                                   '--command', 'truncate table employeeextracttextrelation_t;'.format(self.name)],
-                                  timeout=self.quick_operation_timeout, ignore_error=True)
-        self._run_console_command(['psql', '--dbname', self.name,
-                                   '--command', 'truncate table session_doc_printform_t;'.format(self.name)],
-                                  timeout=self.quick_operation_timeout, ignore_error=True)
-        self._run_console_command(['psql', '--dbname', self.name,
-                                   '--command', 'truncate table session_att_bull_printform_t;'.format(self.name)],
-                                  timeout=self.quick_operation_timeout, ignore_error=True)
-
-        args = ['psql',
-                '--dbname', self.name,
-                '--command', 'update databasefile_t set content_p = null where content_p is not null and '
-                             '(filename_p is null '
-                             'or filename_p not in (\'platform-variables.less\', \'platform.css\', \'shared.css\'));',
-                ]
-        self._run_console_command(args, timeout=self.restore_timeout, ignore_error=True)
+            # Удаляем содержимое таблиц, хранящих печатные формы различных документов, если они есть
+            for table in self.PRINT_FORM_TABLES:
+                self.sql.execute('truncate table {};'.format(table), timeout=self.quick_operation_timeout,
+                                 dbname=self.name, ignore_error=True)
 
-        args = ['psql',
-                '--dbname', self.name,
-                '--command', 'vacuum full;',
-                ]
-        self._run_console_command(args, timeout=self.restore_timeout)
+        with metrics.span('clear database files'):
+            self._clear_database_files()
+
+        with metrics.span('vacuum full'):
+            self.sql.execute('vacuum full;', timeout=self.restore_timeout, dbname=self.name)
 
     def set_1_1(self):
         log.info('Set user and password 1:1 in database %s on server %s', self.name, self.addr)
@@ -186,8 +406,4 @@ class Postgres(DBTools):
               'where ' \
               '(EXISTS (select ID from PRINCIPAL_T where LOGIN_P=\'1\') and LOGIN_P=\'1\') or ' \
               '(not EXISTS (select ID from PRINCIPAL_T where LOGIN_P=\'1\') and id=(select id from PRINCIPAL_T where id in (select PRINCIPAL_ID from ADMIN_T) and ACTIVE_P=true limit 1));'
-        args = ['psql',
-                '--dbname', self.name,
-                '--command', sql,
-                ]
-        self._run_console_command(args, timeout=self.quick_operation_timeout, ignore_error=True)
+        self.sql.execute(sql, timeout=self.quick_operation_timeout, dbname=self.name, ignore_error=True)
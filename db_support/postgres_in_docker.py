@@ -2,11 +2,13 @@ import logging
 import os
 import random
 import subprocess
-import time
 
 from docker import Client
 from docker.errors import NotFound, NullResource
 
+import metrics
+from db_support import postgres_probe
+from db_support.compression import Compression
 from db_support.postgres import Postgres
 
 log = logging.getLogger('[test tools pgdocker]')
@@ -19,6 +21,10 @@ class Pgdocker(Postgres):
         super(Pgdocker, self).__init__(db_config)
 
         self.image = db_config.pgdocker_image
+        # из переменных среды приходит строка
+        self.start_timeout = float(db_config.pgdocker_start_timeout)
+        # сколько последний раз ждали готовности сервера после запуска контейнера
+        self.ready_time = None
         self.docker = Client("unix:///var/run/docker.sock", timeout=1800)
         self.backup_path = os.path.join(db_config.backup_dir, 'default.tar')
 
@@ -64,19 +70,18 @@ class Pgdocker(Postgres):
                                             )['Id']
 
     def _start(self, container):
+        with metrics.span('container start'):
+            self._start_and_wait(container)
+
+    def _start_and_wait(self, container):
         log.debug('try start db container')
         self.docker.start(container)
-        # ждем около 30 секунд пока сервер начнет слушать на порту и инициализаует файловую систему
-        # Сразу после поднятия psql: FATAL:  the database system is starting up
-        for i in range(0, 15):
-            try:
-                super(Pgdocker, self)._run_console_command(['psql', '--list'], 5)
-                return
-
-            except (ConnectionRefusedError, RuntimeError, subprocess.TimeoutExpired):
-                time.sleep(2)
-
-        raise TimeoutError('Pgdocker was not started')
+        # соединения со старым экземпляром сервера уже не живые
+        self.sql.close()
+        # ждем пока сервер начнет слушать на порту и инициализирует файловую систему
+        # Сразу после поднятия: FATAL:  the database system is starting up
+        self.ready_time = postgres_probe.wait_ready(self.addr, int(self.port), self.user, self.start_timeout)
+        metrics.observe('test_tools_phase_duration_seconds', self.ready_time, phase='pgdocker ready')
 
     def _remove(self, container):
         log.debug('remove %s', container)
@@ -97,6 +102,7 @@ class Pgdocker(Postgres):
 
     def drop(self):
         log.info('Drop pgdocker container')
+        self.sql.close()
         self._remove(self._container_name)
         self._save_container(None)
 
@@ -104,31 +110,74 @@ class Pgdocker(Postgres):
         log.info('Backup database container %s on server %s', self._container_name, self.addr)
         # https://www.postgresql.org/docs/9.4/static/backup-file.html
         # The database server must be shut down in order to get a usable backup
+        self.sql.close()
         self.docker.stop(self._container_name, timeout=60)
         self.docker.wait(self._container_name)
-        with open(self.backup_path, "wb") as f:
-            (stream, stat) = self.docker.get_archive(self._container_name, "/var/lib/postgresql/data/.")
-            buffer = stream.read(10000000)
-            while buffer:
-                f.write(buffer)
-                buffer = stream.read(10000000)
-        self._start(self._container_name)
-
-    def restore(self):
+        backup_path = self.compression.path(self.backup_path)
+        # пишем рядом, старый бэкап подменяется только после успешного завершения
+        tmp_path = backup_path + '.tmp'
+        try:
+            self._export_archive(tmp_path)
+        except Exception as e:
+            self._remove_path(tmp_path)
+            raise e
+        finally:
+            self._start(self._container_name)
+
+        os.replace(tmp_path, backup_path)
+        self.compression.remove_stale(self.backup_path, backup_path)
+
+    def _export_archive(self, path):
+        with open(path, "wb") as f:
+            # tar поток из контейнера сжимается на лету, несжатый архив на диск не попадает
+            compressor = self.compression.start_compressor(f) if self.compression.enabled else None
+            out = compressor.stdin if compressor else f
+            try:
+                with metrics.span('archive export'):
+                    (stream, stat) = self.docker.get_archive(self._container_name, "/var/lib/postgresql/data/.")
+                    buffer = stream.read(10000000)
+                    while buffer:
+                        out.write(buffer)
+                        metrics.inc('test_tools_bytes_total', len(buffer), operation='pgdocker_backup')
+                        buffer = stream.read(10000000)
+            except Exception as e:
+                if compressor:
+                    compressor.kill()
+                    compressor.wait()
+                raise e
+            if compressor:
+                Compression.finish(compressor, self.quick_operation_timeout)
+
+    @staticmethod
+    def _read_chunks(f):
+        for buffer in iter(lambda: f.read(10000000), b''):
+            metrics.inc('test_tools_bytes_total', len(buffer), operation='pgdocker_restore')
+            yield buffer
+
+    def _is_filesystem_backup(self, backup_path):
+        if Compression.is_compressed(backup_path):
+            return Compression.peek(backup_path, 512)[257:262] == b'ustar'
+        command = ['file', backup_path]
+        return subprocess.check_output(command, timeout=self.quick_operation_timeout).decode(). \
+            find('POSIX tar archive') != -1
+
+    def restore(self, reduced=False):
         # Если это tar архив, то пробуем развернуть его как filesystem backup в остальных случаях пытаемся
         # обработать его как стандартный архив постгреса
-        command = ['file', self.backup_path]
-        if subprocess.check_output(command, timeout=self.quick_operation_timeout).decode(). \
-                find('POSIX tar archive') != -1:
+        backup_path = self.compression.existing_path(self.backup_path) or self.backup_path
+        if self._is_filesystem_backup(backup_path):
             log.info('Restore filesystem backup for container %s on server %s', self._container_name, self.addr)
             # Сначала сдедует почистить текущие файлы базы данных, для этого удаляем контейнер вместе с томом бд
             # Кроме того, при копировании бэкапа права установятся в root но видимо перепишутся при первом запуске контейнера
+            self.sql.close()
             self._remove(self._container_name)
             new_container_id = self._create_container()
-            with open(self.backup_path, "rb") as f:
-                self.docker.put_archive(new_container_id, "/var/lib/postgresql/data", f)
+            with self._backup_stream(backup_path) as f, metrics.span('archive import'):
+                self.docker.put_archive(new_container_id, "/var/lib/postgresql/data", self._read_chunks(f))
             self._start(new_container_id)
             self._save_container(new_container_id)
+            # файлы базы выборочно не восстановить
+            if reduced:
+                self.reduce()
         else:
-            super(Pgdocker, self).restore()
-
+            super(Pgdocker, self).restore(reduced)
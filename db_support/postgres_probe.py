@@ -0,0 +1,77 @@
+import logging
+import random
+import socket
+import struct
+import time
+
+log = logging.getLogger('[test tools pgdocker]')
+
+PROTOCOL_VERSION = 196608  # 3.0
+# SQLSTATE cannot_connect_now: the database system is starting up / shutting down / in recovery mode
+CANNOT_CONNECT_NOW = '57P03'
+
+
+def _startup_message(user):
+    params = b''.join(s.encode() + b'\0' for s in ('user', user, 'database', 'postgres')) + b'\0'
+    return struct.pack('!ii', 8 + len(params), PROTOCOL_VERSION) + params
+
+
+def _error_code(body):
+    # поля ErrorResponse: байт типа и строка, 'C' - SQLSTATE
+    for field in body.split(b'\0'):
+        if field[:1] == b'C':
+            return field[1:].decode()
+    return None
+
+
+def is_ready(host, port, user, timeout):
+    """
+    Как pg_isready: соединение и стартовое сообщение протокола без авторизации.
+    Сервер готов, если ответил запросом авторизации или любой ошибкой, кроме "the database system is starting up"
+    :return: (готов ли сервер, причина для лога)
+    """
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            sock.sendall(_startup_message(user))
+            header = sock.recv(5)
+            if len(header) < 5:
+                return False, 'connection closed'
+            kind, length = header[:1], struct.unpack('!i', header[1:])[0]
+            if kind != b'E':
+                # R - запрос авторизации, сервер принимает соединения
+                return True, 'accepting connections'
+            body = b''
+            while len(body) < length - 4:
+                chunk = sock.recv(length - 4 - len(body))
+                if not chunk:
+                    break
+                body += chunk
+            code = _error_code(body)
+            return code != CANNOT_CONNECT_NOW, 'error {}'.format(code)
+    except OSError as e:
+        return False, str(e)
+
+
+def wait_ready(host, port, user, timeout, first_delay=0.05, max_delay=2):
+    """
+    Ждет готовности сервера, интервал между попытками растет экспоненциально со случайным разбросом
+    :return: сколько секунд ждали
+    :raise TimeoutError: сервер не готов за timeout секунд
+    """
+    started = time.time()
+    delay = first_delay
+    attempts = 0
+    while True:
+        attempts += 1
+        remaining = timeout - (time.time() - started)
+        ready, reason = is_ready(host, port, user, max(min(remaining, max_delay), 0.1))
+        if ready:
+            elapsed = time.time() - started
+            log.info('Postgres on %s:%s is ready in %.2f sec after %s attempts', host, port, elapsed, attempts)
+            return elapsed
+        log.debug('Postgres on %s:%s is not ready: %s', host, port, reason)
+        remaining = timeout - (time.time() - started)
+        if remaining <= 0:
+            raise TimeoutError('Postgres on {}:{} was not ready in {} sec: {}'.format(host, port, timeout, reason))
+        time.sleep(min(random.uniform(delay / 2, delay), remaining))
+        delay = min(delay * 2, max_delay)
@@ -0,0 +1,87 @@
+import logging
+import threading
+
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+log = logging.getLogger('[test tools postgres]')
+
+
+class SqlExecutor(object):
+    """
+    Выполняет короткие sql запросы в процессе, без запуска psql. Соединения берутся из пула,
+    отдельный пул на каждую базу сервера
+    """
+    CONNECT_TIMEOUT = 10
+
+    def __init__(self, db, pool_size):
+        """
+        :param db: база данных Postgres, параметры подключения читаются из нее при создании пула
+        :param pool_size: максимальное количество соединений с одной базой
+        """
+        self.db = db
+        # из переменных среды приходит строка
+        self.pool_size = max(int(pool_size), 1)
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _pool(self, dbname):
+        with self._lock:
+            if dbname not in self._pools:
+                kw = {'host': self.db.addr,
+                      'user': self.db.user,
+                      'password': self.db.password,
+                      'connect_timeout': self.CONNECT_TIMEOUT}
+                if self.db.port:
+                    kw['port'] = self.db.port
+                # без имени базы libpq подключается к базе с именем пользователя, как и psql
+                if dbname:
+                    kw['dbname'] = dbname
+                self._pools[dbname] = ThreadedConnectionPool(0, self.pool_size, **kw)
+            return self._pools[dbname]
+
+    def close(self, dbname=None):
+        """
+        Закрывает соединения с базой dbname, или со всеми базами сервера. Открытые соединения
+        не дают удалить базу или скопировать ее шаблоном
+        """
+        with self._lock:
+            names = [dbname] if dbname else list(self._pools)
+            for name in names:
+                pool = self._pools.pop(name, None)
+                if pool:
+                    pool.closeall()
+
+    def execute(self, sql, timeout, dbname=None, ignore_error=False, fetch=False):
+        """
+        :param dbname: база для подключения, None - служебная
+        :param fetch: вернуть строки результата, иначе количество измененных строк
+        """
+        log.debug('Run sql. Server %s, database %s, timeout %s, query %s', self.db.addr, dbname, timeout, sql)
+        # второй попытка нужна если соединение в пуле умерло, например после перезапуска сервера
+        for attempt in (1, 2):
+            pool = self._pool(dbname)
+            conn = pool.getconn()
+            broken = False
+            try:
+                # DROP DATABASE и VACUUM нельзя выполнять в транзакции
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute('SET statement_timeout = %s', (int(timeout * 1000),))
+                    cursor.execute(sql)
+                    if fetch:
+                        result = cursor.fetchall()
+                        log.debug('Result: %s', result)
+                        return result
+                    return cursor.rowcount
+            except psycopg2.Error as e:
+                broken = conn.closed != 0
+                if broken and attempt == 1:
+                    log.debug('Connection lost, reconnect: %s', e)
+                    continue
+                if ignore_error:
+                    log.warning(str(e))
+                    return None
+                raise e
+            finally:
+                pool.putconn(conn, close=broken)
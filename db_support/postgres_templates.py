@@ -0,0 +1,116 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+log = logging.getLogger('[test tools postgres]')
+
+
+class TemplateCache(object):
+    """
+    Кэш восстановленных баз в виде шаблонов на сервере postgres. Повторное восстановление того же бэкапа
+    делается через CREATE DATABASE ... TEMPLATE, это секунды вместо часов pg_restore.
+
+    Шаблоны называются <имя базы>_tpl_<ключ бэкапа>, время последнего использования хранится в файле рядом с бэкапом.
+    Лишние шаблоны удаляются начиная с давно не используемых
+    """
+
+    def __init__(self, db, max_count, max_size_gb):
+        """
+        :param db: база данных Postgres, для которой хранятся шаблоны
+        :param max_count: максимальное количество шаблонов, 0 - кэш выключен
+        :param max_size_gb: максимальный суммарный размер шаблонов в гигабайтах, 0 - без ограничения
+        """
+        self.db = db
+        # из переменных среды приходит строка
+        self.max_count = int(max_count)
+        self.max_size = int(float(max_size_gb) * 1024 ** 3)
+        self._prefix = '{}_tpl_'.format(db.name)
+        self._index_file = os.path.join(os.path.dirname(db.backup_path), 'templates.json')
+
+    @property
+    def enabled(self):
+        return self.max_count > 0
+
+    def template_name(self, backup_path, reduced):
+        """
+        Имя шаблона для бэкапа. Ключ меняется вместе с путем, размером и временем изменения бэкапа
+        """
+        # для бэкапа в формате директории смотрим на оглавление, его pg_dump пишет последним
+        stat_path = os.path.join(backup_path, 'toc.dat') if os.path.isdir(backup_path) else backup_path
+        st = os.stat(stat_path)
+        identity = '{}:{}:{}:{}'.format(os.path.abspath(backup_path), st.st_size, st.st_mtime_ns, reduced)
+        return self._prefix + hashlib.sha1(identity.encode()).hexdigest()[:12]
+
+    def exists(self, template):
+        return template in self._templates()
+
+    def restore(self, template):
+        """
+        Создает базу из шаблона. Базы на момент вызова быть не должно
+        """
+        log.info('Restore database %s from template %s', self.db.name, template)
+        self.db.sql.execute('CREATE DATABASE {} TEMPLATE {}'.format(self.db.name, template),
+                            timeout=self.db.middle_operation_timeout)
+        self._touch(template)
+
+    def save(self, template):
+        """
+        Сохраняет текущую базу как шаблон и удаляет лишние шаблоны
+        """
+        log.info('Save database %s as template %s', self.db.name, template)
+        self.db.sql.execute('CREATE DATABASE {} TEMPLATE {}'.format(template, self.db.name),
+                            timeout=self.db.middle_operation_timeout)
+        # Запрещаем подключения, иначе любое открытое соединение не даст скопировать шаблон.
+        # Без прав суперпользователя не получится, тогда шаблон остается обычной базой
+        self.db.sql.execute('UPDATE pg_database SET datistemplate = true, datallowconn = false '
+                            'WHERE datname = \'{}\''.format(template),
+                            timeout=self.db.quick_operation_timeout, ignore_error=True)
+        self._touch(template)
+        self._evict(keep=template)
+
+    def _templates(self):
+        """
+        :return: {имя шаблона: размер в байтах}
+        """
+        rows = self.db.sql.execute('SELECT datname, pg_database_size(datname) FROM pg_database '
+                                   'WHERE datname LIKE \'{}%\''.format(self._prefix.replace('_', '\\_')),
+                                   timeout=self.db.quick_operation_timeout, fetch=True)
+        return {row[0]: int(row[1]) for row in rows}
+
+    def _drop(self, template):
+        log.info('Drop template %s', template)
+        self.db.sql.execute('UPDATE pg_database SET datistemplate = false WHERE datname = \'{}\''.format(template),
+                            timeout=self.db.quick_operation_timeout, ignore_error=True)
+        self.db.sql.execute('DROP DATABASE {}'.format(template), timeout=self.db.quick_operation_timeout)
+
+    def _evict(self, keep):
+        templates = self._templates()
+        last_used = self._read_index()
+        # самые давно используемые в начале списка
+        candidates = sorted((t for t in templates if t != keep), key=lambda t: last_used.get(t, 0))
+        while candidates and (len(templates) > self.max_count
+                              or (self.max_size and sum(templates.values()) > self.max_size)):
+            template = candidates.pop(0)
+            self._drop(template)
+            del templates[template]
+            last_used.pop(template, None)
+        # забываем шаблоны, которых больше нет на сервере
+        self._write_index({t: used for t, used in last_used.items() if t in templates})
+
+    def _touch(self, template):
+        last_used = self._read_index()
+        last_used[template] = time.time()
+        self._write_index(last_used)
+
+    def _read_index(self):
+        try:
+            with open(self._index_file, 'rt') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _write_index(self, last_used):
+        with open(self._index_file, 'wt') as f:
+            json.dump(last_used, f)
@@ -1,15 +1,21 @@
+import functools
 import logging
 import time
 import os
 import shutil
 import subprocess
+import threading
 from contextlib import contextmanager
 
+import metrics
 from config import RootConfig
 from db_support.mssql import Mssql
 from db_support.postgres import Postgres
 from db_support.postgres_in_docker import Pgdocker
-from jenkins import Jenkins
+from jenkins import BuildPrefetcher, Jenkins
+from live_status import StatusModel
+from tomcat_readiness import TomcatReadiness
+from tasks import TaskScheduler, current_job
 
 log = logging.getLogger('[test tools main]')
 
@@ -19,9 +25,32 @@ class Engine(object):
     RESTORE_DB = 'RESTORE_DB'
     BACKUP_DB = 'BACKUP_DB'
     REDUCE_DB = 'REDUCE_DB'
+    RESTORE_REDUCED_DB = 'RESTORE_REDUCED_DB'
     DROP_DB = 'DROP_DB'
     BUILD = 'BUILD'
+    WAIT_BUILD = 'WAIT_BUILD'
     UPLOAD = 'UPLOAD'
+    SWITCH_WEBAPP = 'SWITCH_WEBAPP'
+
+    # Ресурсы, которые занимают задачи. Задачи с общими ресурсами выполняются по очереди
+    DB = 'db'
+    WEBAPP = 'webapp'
+    # свободный слот для поэтапного обновления
+    WEBAPP_STAGE = 'webapp_stage'
+    TOMCAT = 'tomcat'
+    JENKINS = 'jenkins'
+    TASK_RESOURCES = {
+        'new_db': (DB, TOMCAT),
+        'drop_db': (DB, TOMCAT),
+        'restore': (DB, TOMCAT),
+        'restore_reduced': (DB, TOMCAT),
+        'backup': (DB, TOMCAT),
+        'reduce': (DB, TOMCAT),
+        'update': (JENKINS, WEBAPP, TOMCAT),
+        'build_and_update': (JENKINS,),
+        'activate_webapp': (WEBAPP, WEBAPP_STAGE, TOMCAT),
+    }
+    TASK_WORKERS = 4
 
     def __init__(self, config: RootConfig):
         self.config = config
@@ -41,12 +70,21 @@ class Engine(object):
         self._write_hibernate_properties()
 
         self.jenkins = Jenkins(config.jenkins)
+        self.prefetcher = BuildPrefetcher(self.jenkins, config.jenkins)
+        self.prefetcher.start()
 
         os.environ['CATALINA_OPTS'] = config.catalina_opts
         self.tomcat = None
+        self.tomcat_readiness = None
+        self.staged_deploy = str(config.staged_deploy).lower() in ('true', '1')
         self.last_error = None
-        self.active_task = None
+        self._active_tasks = []
         self.last_task = None
+        self.uni_version = self._read_version_file()
+        # состояние для engine_status и подписчиков /events, обновляется при изменениях
+        self.status = StatusModel()
+        self._tasks = TaskScheduler(self.TASK_WORKERS, on_change=self._status_changed)
+        self._status_changed()
 
         log.info('Test tools started')
 
@@ -58,8 +96,14 @@ class Engine(object):
         if not os.path.exists(self.config.UNI_CONFIG_DIR):
             shutil.copytree(self.config.UNI_TEMPLATE_CONFIG_DIR, self.config.UNI_CONFIG_DIR)
 
-        if not os.path.exists(self.config.UNI_WEBAPP):
-            os.mkdir(self.config.UNI_WEBAPP)
+        webapp = self.config.UNI_WEBAPP
+        if os.path.islink(webapp):
+            # при поэтапном обновлении webapp - симлинк на слот. Если слот удалили, создаем его заново пустым
+            if not os.path.exists(webapp):
+                log.warning('Webapp slot %s is missing, recreate it', os.readlink(webapp))
+                os.makedirs(os.path.realpath(webapp), exist_ok=True)
+        elif not os.path.lexists(webapp):
+            os.mkdir(webapp)
 
     def _write_hibernate_properties(self):
         log.debug('Create hibernate file')
@@ -88,9 +132,19 @@ class Engine(object):
                     self.jenkins.version or '',
                     build_details),
             ])
+        self.uni_version = self._read_version_file()
+        self._status_changed()
+
+    def _read_version_file(self):
+        try:
+            with open(self.config.UNI_VERSION_FILE, 'rt') as f:
+                return f.read()
+        except FileNotFoundError:
+            return ''
 
     def exit(self):
         log.info('Shutdown...')
+        self.prefetcher.stop()
         self.stop_tomcat()
         if self.config.db.rm:
             try:
@@ -104,7 +158,12 @@ class Engine(object):
         if self.tomcat is not None and self.tomcat.poll() is None:
             return
 
+        readiness = TomcatReadiness(self.config.CATALINA_LOGS, 'http://localhost:{0}/'.format(self.config.UNI_PORT),
+                                    on_done=self._status_changed)
         self.tomcat = subprocess.Popen([self.config.CATALINA_SH, "run"])
+        readiness.start(self.tomcat)
+        self.tomcat_readiness = readiness
+        self._status_changed()
         # Иначе кто-то может остановить томкат сразу после запуска, что вызовет рождение зомби uname, dirname, tty
         time.sleep(2)
 
@@ -118,44 +177,120 @@ class Engine(object):
             self.tomcat.wait(30)
         except subprocess.TimeoutExpired:
             self.tomcat.kill()
+        self._status_changed()
+
+    def _task_resources(self, action):
+        if action == 'update' and self.staged_deploy:
+            # томкат и webapp нужны только на подмену, она ставится отдельной задачей
+            return self.JENKINS, self.WEBAPP_STAGE
+        return self.TASK_RESOURCES[action]
 
-    def log_exceptions(self, runnable):
+    def _run_action(self, action, *args):
         try:
-            runnable()
+            result = getattr(self, action)(*args)
             # Убрать предудущую индикацию об ошибке. Иначе вообще непонятно будет все хорошо или не очень
             self.last_error = None
+            return result
         except Exception as e:
+            # ошибка остается и в работе, ее увидит /jobs/<id>
             self.last_error = str(e)
             log.exception(e)
+            raise
+        finally:
+            self._status_changed()
+
+    @staticmethod
+    def _newer_build(build, pending):
+        # None - последняя сборка, новее любой конкретной. С конкретной сборкой обновление ставит только
+        # build_and_update, из веб-интерфейса - всегда последняя
+        pending_build = pending.args[1] if len(pending.args) > 1 else None
+        if pending_build is None:
+            return False
+        return build is None or build > pending_build
+
+    def submit(self, action, *args, urgent=False, job=None):
+        """
+        Помещает длинную задачу в очередь задач. Повторные нажатия не ставят задачу еще раз:
+        такая же ожидающая задача возвращается вместо новой, обновление на более новую сборку
+        заменяет ожидающее обновление. Обновление - продолжение сборки тоже объединяется с ожидающим обновлением,
+        его работа тогда завершится вместе с ним
+        :param action: имя метода engine из TASK_RESOURCES
+        :param job: продолжить эту работу
+        :return: Job, по id его статус доступен в /jobs/<id>
+        """
+        if action == 'update':
+            key = action
+            build = args[0] if args else None
+            supersedes = functools.partial(self._newer_build, build)
+        elif job is not None:
+            # продолжение конкретной работы, не объединяем
+            key, supersedes = None, None
+        else:
+            key, supersedes = (action,) + args, None
+        return self._tasks.submit(action, self._task_resources(action), self._run_action, action, *args,
+                                  key=key, supersedes=supersedes, urgent=urgent, job=job)
+
+    def job(self, job_id):
+        return self._tasks.job(job_id)
+
+    def jobs(self):
+        return self._tasks.jobs()
+
+    def render_metrics(self):
+        """
+        :return: метрики в текстовом формате Prometheus
+        """
+        tasks = self._tasks.status()
+        for state in ('running', 'pending'):
+            metrics.set_gauge('test_tools_tasks', len([t for t in tasks if t['state'] == state]), state=state)
+        metrics.set_gauge('test_tools_tomcat_up', int(self.tomcat is not None and self.tomcat.poll() is None))
+        return metrics.render()
+
+    @property
+    def active_task(self):
+        return ', '.join(self._active_tasks) or None
 
     @contextmanager
     def _new_task(self, task_name):
-        self.active_task = task_name
+        self._active_tasks.append(task_name)
         log.info("Task %s started", task_name)
+        self._status_changed()
         try:
-            yield
+            with metrics.span(task_name):
+                yield
         finally:
             self.last_task = task_name
-            self.active_task = None
-            log.info("Task finished")
+            self._active_tasks.remove(task_name)
+            log.info("Task %s finished", task_name)
+            self._status_changed()
 
-    def engine_status(self):
+    def _status_changed(self):
         if self.tomcat is not None:
             returncode = self.tomcat.poll()
         else:
             returncode = 0
+        readiness = self.tomcat_readiness
+        uni_ready = returncode is None and readiness is not None and readiness.ready.done() and readiness.ready.result()
+
+        self.status.update(uni_ready=uni_ready,
+                           last_error=self.last_error,
+                           last_task=self.last_task,
+                           active_task=self.active_task,
+                           tasks=self._tasks.status(),
+                           db_addr=self.db.addr,
+                           tomcat_returncode=returncode,
+                           uni_version=self.uni_version)
+
+    def check_tomcat(self):
+        """
+        Томкат может упасть сам, состояние процесса проверяется периодически. poll() не блокирует
+        """
+        if self.tomcat_readiness is not None:
+            self.tomcat_readiness.recheck()
+        self._status_changed()
 
-        with open(self.config.UNI_VERSION_FILE, 'rt') as f:
-            uni_version = f.read()
-
-        return {
-            "last_error": self.last_error,
-            "last_task": self.last_task,
-            "active_task": self.active_task,
-            "db_addr": self.db.addr,
-            "tomcat_returncode": returncode,
-            'uni_version': uni_version,
-        }
+    def engine_status(self):
+        return self.status.snapshot()[1]
 
     def new_db(self):
         self.stop_tomcat()
@@ -177,6 +312,16 @@ class Engine(object):
             self.db.restore()
             self.db.set_1_1()
 
+    def restore_reduced(self):
+        """
+        Восстановление сразу уменьшенной базы, заменяет последовательность restore + reduce
+        """
+        self.stop_tomcat()
+        with self._new_task(Engine.RESTORE_REDUCED_DB):
+            self.db.restore(reduced=True)
+            self.db.customer_patch()
+            self.db.set_1_1()
+
     def backup(self):
         self.stop_tomcat()
         with self._new_task(Engine.BACKUP_DB):
@@ -188,13 +333,71 @@ class Engine(object):
             self.db.reduce()
             self.db.customer_patch()
 
+    def _inactive_webapp_slot(self):
+        active = os.path.realpath(self.config.UNI_WEBAPP)
+        for slot in ('a', 'b'):
+            path = os.path.join(self.config.UNI_WEBAPP_SLOTS, slot)
+            if os.path.realpath(path) != active:
+                os.makedirs(path, exist_ok=True)
+                return path
+
+    def _activate_webapp_slot(self, slot_dir):
+        log.debug('Switch webapp to %s', slot_dir)
+        webapp = self.config.UNI_WEBAPP
+        if not os.path.islink(webapp):
+            # первое поэтапное обновление, на месте симлинка пока обычная директория. Томкат уже остановлен
+            shutil.rmtree(webapp)
+        # симлинк подменяется атомарно, томкат видит либо старую, либо новую сборку целиком
+        tmp_link = webapp + '.tmp'
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(slot_dir, tmp_link)
+        os.replace(tmp_link, webapp)
+
     def update(self, build=None):
-        self.stop_tomcat()
+        if not self.staged_deploy:
+            self.stop_tomcat()
+            with self._new_task(Engine.UPLOAD):
+                self._write_version_file(self.jenkins.get_build(os.path.realpath(self.config.UNI_WEBAPP), build))
+            self.start_tomcat()
+            return
+
         with self._new_task(Engine.UPLOAD):
-            self._write_version_file(self.jenkins.get_build(self.config.UNI_WEBAPP, build))
+            # пока сборка качается и распаковывается в свободный слот, uni продолжает работать
+            slot_dir = self._inactive_webapp_slot()
+            build_details = self.jenkins.get_build(slot_dir, build)
+        # подмена встает в начало очереди, чтобы следующее обновление не переписало слот до переключения
+        return self.submit('activate_webapp', slot_dir, build_details, urgent=True, job=current_job())
+
+    def activate_webapp(self, slot_dir, build_details):
+        self.stop_tomcat()
+        with self._new_task(Engine.SWITCH_WEBAPP):
+            self._activate_webapp_slot(slot_dir)
+            self._write_version_file(build_details)
         self.start_tomcat()
 
     def build_and_update(self):
+        """
+        Ставит сборку в очередь jenkins и сразу освобождает поток задач. Сборку ждет отдельный поток,
+        после успешной сборки обновление ставится в очередь задач продолжением той же работы
+        :return: текущая работа, она завершится после обновления
+        """
         with self._new_task(Engine.BUILD):
-            build = self.jenkins.build_project()
-        self.update(build)
+            queue_url = self.jenkins.start_build()
+
+        job = current_job()
+
+        def wait_and_update():
+            try:
+                with metrics.span(Engine.WAIT_BUILD, job=job):
+                    build = self.jenkins.wait_build(queue_url)
+            except Exception as e:
+                self.last_error = str(e)
+                log.exception(e)
+                job.finish(error=e)
+                self._status_changed()
+                return
+            self.submit('update', build, job=job)
+
+        threading.Thread(target=wait_and_update, name='build wait', daemon=True).start()
+        return job
@@ -1,65 +1,91 @@
+import datetime
 import logging
 import os
 import shutil
+import threading
 import time
 import zipfile
 import pytz
 
-import jenkinsapi
-
-from config import JenkinsConfig
+import metrics
+import webapp
+from config import JenkinsConfig, RootConfig
+from jenkins_client import JenkinsClient
 
 log = logging.getLogger('[test tools jenkins]')
 
 
 class Jenkins:
+    BUILD_TIMEOUT = 3600
+    MIN_POLL_INTERVAL = 2
+    MAX_POLL_INTERVAL = 30
+    # fingerprint - md5 артефактов, им проверяется скачанный файл
+    BUILD_TREE = 'number,result,building,timestamp,artifacts[relativePath,fileName],fingerprint[fileName,hash]'
+
     def __init__(self, jenkins_config):
-        # https://jenkinsapi.readthedocs.io/en/latest/build.html
+        # https://wiki.jenkins.io/display/JENKINS/Remote+access+API
         assert isinstance(jenkins_config, JenkinsConfig)
         self.url = jenkins_config.url
         self.user = jenkins_config.user
         self.password = jenkins_config.password
         self.project = jenkins_config.project
         self.version = jenkins_config.branch
+        self.incremental_deploy = str(jenkins_config.incremental_deploy).lower() in ('true', '1')
+        self.cache = webapp.ArtifactCache(RootConfig.ARTIFACT_CACHE, jenkins_config.artifact_cache_size_gb)
+        self.client = JenkinsClient(self.url, self.user, self.password)
+        self._download_lock = threading.Lock()
 
-    def build_project(self):
+    def start_build(self):
         """
-        Запускает job и ждет окончания
-        :return:Номер сборки
+        Ставит job в очередь
+        :return: url элемента очереди, по нему wait_build узнает номер сборки
         """
         log.debug('call build project %s and version %s', self.project, self.version)
-        s = jenkinsapi.jenkins.Jenkins(self.url,
-                                       username=self.user,
-                                       password=self.password)
-        job = s[self.project]
 
         if self.version:
             params = {'Version': self.version}
         else:
             params = None
 
-        build_number = job.get_next_build_number()
-        log.info('start build project %s with params %s, build %s', self.project, params, build_number)
-        s.build_job(self.project, params)
-
-        # jenkinsapi не считает билд существующим пока не начнется его фактическая сборка, поэтому приходится писать так
-        elapsed_time = 0
-        while 1:
-            if elapsed_time > 600:
-                break
-            try:
-                if not job.get_build(build_number).is_running():
-                    break
-            except KeyError:
-                pass
-            log.debug('wait build')
-            elapsed_time += 15
-            time.sleep(15)
-
-        if not job.get_build(build_number).is_good():
-            raise RuntimeError('Last build is incorrect')
+        log.info('start build project %s with params %s', self.project, params)
+        with metrics.span('queue build'):
+            queue_url = self.client.build_job(self.project, params)
+        if not queue_url:
+            raise RuntimeError('Jenkins did not return queue item for project %s' % self.project)
+        return queue_url
 
-        return build_number
+    def wait_build(self, queue_url):
+        """
+        Ждет пока элемент очереди станет сборкой и сборка завершится. Пока сборка идет, опрос все реже
+        :return: Номер успешной сборки
+        """
+        deadline = time.time() + self.BUILD_TIMEOUT
+        interval = self.MIN_POLL_INTERVAL
+        build_number = None
+        while time.time() < deadline:
+            if build_number is None:
+                item = self.client.queue_item(queue_url, 'cancelled,why,executable[number]')
+                if item.get('cancelled'):
+                    raise RuntimeError('Build of project %s was cancelled in queue' % self.project)
+                if item.get('executable'):
+                    build_number = item['executable']['number']
+                    log.info('Build %s of project %s started', build_number, self.project)
+                    interval = self.MIN_POLL_INTERVAL
+                else:
+                    log.debug('wait build in queue: %s', item.get('why'))
+
+            if build_number is not None:
+                build = self.client.build(self.project, build_number, 'building,result')
+                if not build['building']:
+                    if build['result'] != 'SUCCESS':
+                        raise RuntimeError('Build %s is incorrect: %s' % (build_number, build['result']))
+                    return build_number
+                log.debug('wait build %s', build_number)
+
+            time.sleep(interval)
+            interval = min(interval * 1.5, self.MAX_POLL_INTERVAL)
+
+        raise RuntimeError('Build of project %s was not finished in %s sec' % (self.project, self.BUILD_TIMEOUT))
 
     def get_build(self, dir_for_files, build_number=None):
         """
@@ -68,47 +94,143 @@ class Jenkins:
         :param build_number: Номер сборки
         """
         log.info('Get build. Project: %s, directory: %s, build: %s', self.project, dir_for_files, build_number)
-        s = jenkinsapi.jenkins.Jenkins(self.url,
-                                       username=self.user,
-                                       password=self.password)
-        job = s[self.project]
-
-        if build_number:
-            build = job.get_build(build_number)
-        else:
-            build = job.get_last_build()
-            build_number = build.get_number()
+        # Конкретная сборка из кэша разворачивается без обращений к jenkins. Номер последней сборки спрашиваем
+        # у jenkins каждый раз, кэш используется только для той же сборки.
+        # Поиск под блокировкой: предзагрузка в это время может докачивать эту же сборку
+        with self._download_lock:
+            cached = self.cache.find(self.project, build_number) if build_number else None
+            if not cached:
+                build = self._build_info(build_number)
+                cached = self.cache.get(self.project, build['number'], self._fingerprint(build))
+            if cached:
+                war_file, build_details = cached
+            else:
+                with metrics.span('download'):
+                    war_file, build_details = self._download_artifact(build, build['number'], None)
+
+        log.debug('Unpack war')
+        with metrics.span('deploy'):
+            webapp.deploy(war_file, dir_for_files, dir_for_files.rstrip(os.sep) + '.manifest.json',
+                          self.incremental_deploy)
+        return build_details
+
+    def last_good_build_number(self):
+        return self.client.job(self.project, 'lastSuccessfulBuild[number]')['lastSuccessfulBuild']['number']
+
+    def _build_info(self, build_number=None):
+        """
+        Описание сборки одним запросом, последней если номер не задан
+        """
+        if not build_number:
+            return self.client.job(self.project, 'lastBuild[{}]'.format(self.BUILD_TREE))['lastBuild']
+        return self.client.build(self.project, build_number, self.BUILD_TREE)
 
-        log.debug('%s build status %s', build.get_number(), build.get_status())
+    @staticmethod
+    def _artifact(build):
+        if not build['artifacts']:
+            raise RuntimeError('Build %s has no artifacts' % build['number'])
+        return build['artifacts'][0]
 
-        if not build.is_good():
+    def _fingerprint(self, build):
+        """
+        :return: md5 артефакта по данным jenkins, None если job не записывает отпечатки
+        """
+        file_name = self._artifact(build)['fileName']
+        for fingerprint in build.get('fingerprint') or []:
+            if fingerprint['fileName'] == file_name:
+                return fingerprint['hash']
+        log.warning('Jenkins has no fingerprint of %s, download is checked by size only', file_name)
+        return None
+
+    def _download_build(self, build_number, max_bytes_per_sec=None):
+        """
+        Скачивает war сборки в кэш
+        :return: (путь к war в кэше, описание сборки)
+        """
+        # одну сборку могут одновременно качать обновление и фоновая предзагрузка
+        with self._download_lock:
+            build = self._build_info(build_number)
+            cached = self.cache.get(self.project, build_number, self._fingerprint(build))
+            if cached:
+                return cached
+            return self._download_artifact(build, build_number, max_bytes_per_sec)
+
+    def _download_artifact(self, build, build_number, max_bytes_per_sec):
+        log.debug('%s build status %s', build_number, build['result'])
+
+        if build['building'] or build['result'] != 'SUCCESS':
             raise RuntimeError('Last build of project %s is not SUCCESS' % self.project)
 
-        # очищаем директорию
-        shutil.rmtree(dir_for_files)
-        os.mkdir(dir_for_files)
-        war_file = os.path.join(dir_for_files, 'last_build.war')
+        build_ts = datetime.datetime.utcfromtimestamp(build['timestamp'] / 1000)
+        local_datetime_string = build_ts.replace(tzinfo=pytz.utc).astimezone(pytz.timezone('Asia/Yekaterinburg')) \
+            .strftime('%d.%m.%Y %H:%M')
+        build_details = '{0} build {1}'.format(local_datetime_string, build_number)
 
         log.debug('start loading build artifact for project %s and build number %s', self.project, build_number)
-        for war in build.get_artifacts():
-            assert isinstance(war, jenkinsapi.artifact.Artifact)
-            log.debug('download %s to %s', war.filename, war_file)
-
+        artifact = self._artifact(build)
+        fingerprint = self._fingerprint(build)
+        war_file = self.cache.download_path(self.project, build_number, fingerprint)
+        log.debug('download %s to %s', artifact['fileName'], war_file)
+        try:
+            md5 = webapp.download(self.client.session,
+                                  self.client.artifact_url(self.project, build_number, artifact['relativePath']),
+                                  war_file, max_bytes_per_sec, timeout=self.client.TIMEOUT)
+        except Exception as e:
+            if os.path.exists(war_file):
+                os.remove(war_file)
+            raise e
+
+        if not zipfile.is_zipfile(war_file):
+            os.remove(war_file)
+            raise RuntimeError('Cannot unpack build artifact. It is not zip file')
+
+        return self.cache.add(self.project, build_number, fingerprint, war_file, md5, build_details), build_details
+
+
+class BuildPrefetcher(object):
+    """
+    Фоновая предзагрузка. Раз в interval секунд смотрит последнюю успешную сборку проекта и скачивает ее в кэш,
+    чтобы обновление разворачивало ее с локального диска
+    """
+
+    def __init__(self, jenkins, jenkins_config):
+        assert isinstance(jenkins, Jenkins)
+        self.jenkins = jenkins
+        # из переменных среды приходят строки
+        self.interval = int(jenkins_config.prefetch_interval)
+        self.max_bytes_per_sec = int(float(jenkins_config.prefetch_bandwidth_mb) * 1024 ** 2) or None
+        self.min_free_bytes = int(float(jenkins_config.prefetch_min_free_gb) * 1024 ** 3)
+        # последняя успешная сборка, которая уже лежит в кэше
+        self.latest_build = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self.interval <= 0:
+            log.info('Build prefetch disabled')
+            return
+        threading.Thread(target=self._run, name='build prefetch', daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
             try:
-                war.save(war_file, strict_validation=False)
-            # костыль, не знаю почему исключение
-            except jenkinsapi.custom_exceptions.ArtifactBroken:
-                pass
-
-            if not zipfile.is_zipfile(war_file):
-                raise RuntimeError('Cannot unpack build artifact. It is not zip file')
-
-            log.debug('Unpack war')
-            f = zipfile.ZipFile(war_file)
-            f.extractall(path=dir_for_files)
-            f.close()
-
-            build_ts = build.get_timestamp()
-            local_datetime_string = build_ts.replace(tzinfo=pytz.utc).astimezone(pytz.timezone('Asia/Yekaterinburg')) \
-                .strftime('%d.%m.%Y %H:%M')
-            return '{0} build {1}'.format(local_datetime_string, build_number)
+                self._prefetch()
+            except Exception as e:
+                log.warning('Build prefetch failed: %s', e)
+            self._stop.wait(self.interval)
+
+    def _prefetch(self):
+        build_number = self.jenkins.last_good_build_number()
+        if build_number == self.latest_build:
+            return
+
+        free = shutil.disk_usage(self.jenkins.cache.cache_dir).free
+        if free < self.min_free_bytes:
+            log.warning('Skip prefetch of build %s, only %s MB free on disk', build_number, free // 1024 ** 2)
+            return
+
+        log.info('Prefetch build %s of project %s', build_number, self.jenkins.project)
+        self.jenkins._download_build(build_number, self.max_bytes_per_sec)
+        self.latest_build = build_number
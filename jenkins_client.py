@@ -0,0 +1,73 @@
+import logging
+import time
+from urllib.parse import quote
+
+import requests
+
+log = logging.getLogger('[test tools jenkins]')
+
+
+class JenkinsClient(object):
+    """
+    Минимальный клиент jenkins REST API. В отличие от jenkinsapi ничего не загружает заранее:
+    запрашивается только нужная job или сборка и только нужные поля (параметр tree).
+    Соединения переиспользуются через requests.Session
+    """
+    TIMEOUT = 60
+
+    def __init__(self, url, user, password):
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+        self.session.auth = (user, password)
+
+    def _request(self, method, path, **kw):
+        url = path if path.startswith('http') else self.url + path
+        started = time.time()
+        response = self.session.request(method, url, timeout=self.TIMEOUT, **kw)
+        log.info('Jenkins %s %s: %s in %.3f sec', method, url, response.status_code, time.time() - started)
+        if response.status_code == 404:
+            raise KeyError(url)
+        response.raise_for_status()
+        return response
+
+    def _json(self, path, tree):
+        return self._request('GET', path + '/api/json', params={'tree': tree}).json()
+
+    @staticmethod
+    def _job_path(project):
+        return '/job/{}'.format(quote(project))
+
+    def job(self, project, tree):
+        return self._json(self._job_path(project), tree)
+
+    def build(self, project, build_number, tree):
+        """
+        :raise KeyError: сборки нет, например она еще в очереди
+        """
+        return self._json('{}/{}'.format(self._job_path(project), build_number), tree)
+
+    def queue_item(self, queue_url, tree):
+        """
+        :param queue_url: url элемента очереди, который вернул build_job
+        """
+        return self._json(queue_url.rstrip('/'), tree)
+
+    def artifact_url(self, project, build_number, relative_path):
+        return '{}{}/{}/artifact/{}'.format(self.url, self._job_path(project), build_number, quote(relative_path))
+
+    def _crumb_headers(self):
+        # при включенной защите от CSRF POST запросы требуют crumb
+        try:
+            crumb = self._json('/crumbIssuer', 'crumbRequestField,crumb')
+        except KeyError:
+            return {}
+        return {crumb['crumbRequestField']: crumb['crumb']}
+
+    def build_job(self, project, params=None):
+        """
+        Ставит сборку в очередь
+        :return: url элемента очереди
+        """
+        path = self._job_path(project) + ('/buildWithParameters' if params else '/build')
+        response = self._request('POST', path, params=params, headers=self._crumb_headers())
+        return response.headers.get('Location')
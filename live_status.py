@@ -0,0 +1,52 @@
+import datetime
+import threading
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.locks import Condition
+
+
+class StatusModel(object):
+    """
+    Текущее состояние стенда в памяти. Меняется из потоков задач только когда что-то действительно поменялось,
+    каждое изменение увеличивает версию. Подписчики ждут следующую версию на условии IOLoop, а не опрашивают.
+    Ожидание с таймаутом по его истечении снимается с условия, долгие простои ничего не накапливают
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = {}
+        self.version = 0
+        # ожидающие следующую версию, только на IOLoop
+        self._changed = Condition()
+
+    def snapshot(self):
+        """
+        :return: (версия, копия состояния)
+        """
+        with self._lock:
+            return self.version, dict(self._state)
+
+    def update(self, **fields):
+        with self._lock:
+            changed = {k: v for k, v in fields.items() if k not in self._state or self._state[k] != v}
+            if not changed:
+                return
+            self._state.update(changed)
+            self.version += 1
+        IOLoop.instance().add_callback(self._notify)
+
+    def _notify(self):
+        self._changed.notify_all()
+
+    def wait(self, version, timeout):
+        """
+        Вызывается на IOLoop
+        :param timeout: секунд
+        :return: future: True когда версия станет больше version, False если за timeout не изменилась
+        """
+        if self.version > version:
+            done = Future()
+            done.set_result(True)
+            return done
+        return self._changed.wait(timeout=datetime.timedelta(seconds=timeout))
@@ -1,12 +1,12 @@
 #!/usr/bin/env python3
 import signal
 
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.web import Application
 
 from config import RootConfig
 from engine import Engine
-from web_handlers import ActionHandler, MainPageHandler, AdminPageHandler
+from web_handlers import ActionHandler, JobHandler, MainPageHandler, AdminPageHandler, StatusEventsHandler
 
 
 def main():
@@ -15,11 +15,14 @@ def main():
     application = Application([
         (r'/', MainPageHandler),
         (r'/admin/*', AdminPageHandler),
+        (r'/jobs/?([^/]*)', JobHandler),
+        (r'/events', StatusEventsHandler),
         (r'/(.*)', ActionHandler),
     ])
 
     engine = Engine(conf)
     application.engine = engine
+    PeriodicCallback(engine.check_tomcat, 1000).start()
 
     def exit_handler(signum, frame):
         engine.exit()
@@ -0,0 +1,125 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from tasks import current_job
+
+log = logging.getLogger('[test tools main]')
+
+# границы корзин гистограммы длительностей, сек. Этапы идут от долей секунды до нескольких часов
+DURATION_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800, 3600, 7200)
+
+_lock = threading.Lock()
+_local = threading.local()
+# {(имя метрики, метки): значение}
+_counters = {}
+_gauges = {}
+# {(имя метрики, метки): [счетчики по корзинам, сумма, количество]}
+_histograms = {}
+_help = {
+    'test_tools_phase_duration_seconds': 'Duration of task phases',
+    'test_tools_phase_total': 'Finished task phases by result',
+    'test_tools_bytes_total': 'Bytes moved by operation',
+    'test_tools_tasks': 'Tasks in queue by state',
+    'test_tools_tomcat_up': 'Tomcat process is running',
+}
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    with _lock:
+        key = (name, _labels(labels))
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[(name, _labels(labels))] = value
+
+
+def observe(name, value, **labels):
+    with _lock:
+        key = (name, _labels(labels))
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * len(DURATION_BUCKETS), 0, 0]
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+@contextmanager
+def span(name, job=None):
+    """
+    Этап задачи. Этапы вложены: имя этапа - путь от внешнего этапа, например RESTORE_DB/pg_restore.
+    Длительность попадает в гистограмму и в этапы текущей работы (/jobs/<id>)
+    :param job: работа, если этап идет вне потока задачи
+    """
+    stack = getattr(_local, 'spans', None)
+    if stack is None:
+        stack = _local.spans = []
+    stack.append(name)
+    phase = '/'.join(stack)
+    job = job or current_job()
+    started = time.time()
+    result = 'error'
+    try:
+        if job is not None:
+            with job.new_phase(phase):
+                yield
+        else:
+            yield
+        result = 'ok'
+    finally:
+        stack.pop()
+        duration = time.time() - started
+        observe('test_tools_phase_duration_seconds', duration, phase=phase)
+        inc('test_tools_phase_total', phase=phase, result=result)
+        log.info('Phase %s took %.1f sec', phase, duration)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format(name, labels, value):
+    if labels:
+        name += '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels) + '}'
+    return '{} {}'.format(name, value)
+
+
+def render():
+    """
+    :return: метрики в текстовом формате Prometheus
+    """
+    lines = []
+    described = set()
+
+    def describe(name, metric_type):
+        if name not in described:
+            described.add(name)
+            if name in _help:
+                lines.append('# HELP {} {}'.format(name, _help[name]))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+
+    with _lock:
+        for (name, labels), value in sorted(_counters.items()):
+            describe(name, 'counter')
+            lines.append(_format(name, labels, value))
+        for (name, labels), value in sorted(_gauges.items()):
+            describe(name, 'gauge')
+            lines.append(_format(name, labels, value))
+        for (name, labels), (buckets, total, count) in sorted(_histograms.items()):
+            describe(name, 'histogram')
+            for bound, bucket_count in zip(DURATION_BUCKETS, buckets):
+                lines.append(_format(name + '_bucket', labels + (('le', bound),), bucket_count))
+            lines.append(_format(name + '_bucket', labels + (('le', '+Inf'),), count))
+            lines.append(_format(name + '_sum', labels, total))
+            lines.append(_format(name + '_count', labels, count))
+    return '\n'.join(lines) + '\n'
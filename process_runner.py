@@ -0,0 +1,98 @@
+import collections
+import logging
+import subprocess
+import threading
+
+log = logging.getLogger('[test tools process]')
+
+# сколько последних строк вывода держать в памяти для лога ошибки
+TAIL_LINES = 200
+# дальше вывод в файл не пишется, pg_restore с ignore_error может выдать сотни мегабайт ошибок
+MAX_LOG_BYTES = 50 * 1024 ** 2
+READ_SIZE = 64 * 1024
+
+ProcessResult = collections.namedtuple('ProcessResult', ['returncode', 'out', 'tail'])
+
+
+class _OutputSink(object):
+    """
+    Вывод процесса построчно: последние строки в кольцевом буфере, весь вывод (до MAX_LOG_BYTES) в файл.
+    Пишут потоки stdout и stderr
+    """
+
+    def __init__(self, log_file):
+        self.log_file = log_file
+        self.tail = collections.deque(maxlen=TAIL_LINES)
+        self._written = 0
+        self._partial = b''
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        with self._lock:
+            self._write(data)
+
+    def _write(self, data):
+        if self._written < MAX_LOG_BYTES:
+            chunk = data[:MAX_LOG_BYTES - self._written]
+            self.log_file.write(chunk)
+            self._written += len(chunk)
+            if self._written >= MAX_LOG_BYTES:
+                self.log_file.write(b'\n... output truncated\n')
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self.tail.append(line.decode(errors='replace'))
+
+    def close(self):
+        if self._partial:
+            self.tail.append(self._partial.decode(errors='replace'))
+            self._partial = b''
+
+
+def _read(pipe, write):
+    with pipe:
+        for data in iter(lambda: pipe.read1(READ_SIZE), b''):
+            write(data)
+
+
+def _start_reader(pipe, write):
+    reader = threading.Thread(target=_read, args=(pipe, write), daemon=True)
+    reader.start()
+    return reader
+
+
+def run(args, timeout, stdin=None, stdout=None, capture=False, log_path='/dev/null'):
+    """
+    Запускает процесс и ждет его завершения в текущем потоке. Вывод читается потоково отдельными потоками
+    и в память целиком не попадает
+    :param stdin: файл или пайп для stdin процесса
+    :param stdout: куда перенаправить stdout, None - читать вместе с stderr
+    :param capture: вернуть stdout целиком, например оглавление pg_restore --list
+    :param log_path: файл для вывода процесса, перезаписывается
+    :return: ProcessResult(код возврата, stdout если capture, последние строки вывода)
+    :raise subprocess.TimeoutExpired: процесс не завершился за timeout секунд и был убит
+    """
+    out = []
+    with open(log_path, 'wb') as log_file:
+        sink = _OutputSink(log_file)
+        # stdout без перенаправления тоже идет в лог, в память только если нужен результат
+        stream_stdout = stdout is None
+        process = subprocess.Popen(args, stdin=stdin, stderr=subprocess.PIPE,
+                                   stdout=subprocess.PIPE if stream_stdout else stdout)
+        readers = [_start_reader(process.stderr, sink.write)]
+        if stream_stdout:
+            readers.append(_start_reader(process.stdout, out.append if capture else sink.write))
+
+        try:
+            process.wait(timeout)
+        except subprocess.TimeoutExpired as e:
+            log.warning('Process %s was not finished in %s sec, kill it', args[0], timeout)
+            process.kill()
+            process.wait()
+            raise e
+        finally:
+            for reader in readers:
+                reader.join()
+            sink.close()
+
+    return ProcessResult(process.returncode, b''.join(out) if capture else None, list(sink.tail))
@@ -0,0 +1,264 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+log = logging.getLogger('[test tools main]')
+
+_local = threading.local()
+
+
+def current_job():
+    """
+    :return: Job, задача которого выполняется в текущем потоке, или None
+    """
+    return getattr(_local, 'job', None)
+
+
+class Job(object):
+    """
+    То, что поставил пользователь: одна или несколько задач очереди. Задача может поставить продолжение
+    в ту же работу (например подмену webapp после загрузки сборки), тогда работа завершится вместе с продолжением
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, name, on_change=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.state = Job.PENDING
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.phases = []
+        self.error = None
+        # результат или исключение всей работы, ее ждут синхронные запросы
+        self.future = Future()
+        self._on_change = on_change or (lambda: None)
+
+    @property
+    def phase(self):
+        for phase in reversed(self.phases):
+            if phase['finished'] is None:
+                return phase['name']
+        return None
+
+    @contextmanager
+    def new_phase(self, name):
+        phase = {'name': name, 'started': time.time(), 'finished': None}
+        self.phases.append(phase)
+        self._on_change()
+        try:
+            yield
+        finally:
+            phase['finished'] = time.time()
+            self._on_change()
+
+    def start(self):
+        if self.started is None:
+            self.started = time.time()
+        self.state = Job.RUNNING
+        self._on_change()
+
+    def finish(self, result=None, error=None):
+        self.finished = time.time()
+        if error is not None:
+            self.state = Job.FAILED
+            self.error = str(error)
+            self.future.set_exception(error)
+        else:
+            self.state = Job.DONE
+            self.future.set_result(result)
+        self._on_change()
+
+    def status(self):
+        now = time.time()
+        return {
+            'id': self.id,
+            'name': self.name,
+            'state': self.state,
+            'phase': self.phase,
+            'error': self.error,
+            'submitted': self.submitted,
+            'waiting_sec': round((self.started or now) - self.submitted, 3),
+            'running_sec': round((self.finished or now) - self.started, 3) if self.started else 0,
+            'phases': [{
+                'name': p['name'],
+                'duration_sec': round((p['finished'] or now) - p['started'], 3),
+                'finished': p['finished'] is not None,
+            } for p in self.phases],
+        }
+
+
+class Task(object):
+    PENDING = 'pending'
+    RUNNING = 'running'
+
+    def __init__(self, name, resources, fn, args, key, job):
+        self.name = name
+        self.key = key
+        self.resources = frozenset(resources)
+        self.fn = fn
+        self.args = args
+        self.job = job
+        self.state = Task.PENDING
+        self.submitted = time.time()
+        self.started = None
+
+    def status(self):
+        # время отметками, а не длительностью: статус не меняется, пока задача не сменит состояние или этап
+        return {
+            'name': self.name,
+            'job': self.job.id,
+            'phase': self.job.phase,
+            'state': self.state,
+            'resources': sorted(self.resources),
+            'submitted': self.submitted,
+            'started': self.started,
+        }
+
+
+class TaskScheduler(object):
+    """
+    Очередь длинных задач. Каждая задача заявляет ресурсы, которые она занимает (база, webapp, томкат, ...).
+    Задачи без общих ресурсов выполняются одновременно, задачи с общими ресурсами - строго в порядке постановки:
+    задача не обгоняет стоящую раньше в очереди задачу, с которой у нее есть общие ресурсы
+    """
+    # сколько завершенных работ помнить для /jobs
+    JOBS_HISTORY = 100
+
+    def __init__(self, max_workers, on_change=None):
+        """
+        :param on_change: вызывается без блокировки после любого изменения очереди или работ
+        """
+        self.max_workers = max_workers
+        self._on_change = on_change or (lambda: None)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        # в порядке постановки
+        self._pending = []
+        self._running = []
+        self._jobs = OrderedDict()
+
+    def submit(self, name, resources, fn, *args, key=None, supersedes=None, urgent=False, job=None):
+        """
+        :param key: ключ для объединения. Если в очереди уже ждет задача с тем же ключом, новая не ставится,
+        возвращается future ожидающей задачи
+        :param supersedes: функция (ожидающая задача) -> bool. True - новая задача заменяет аргументы ожидающей,
+        например обновление на более новую сборку
+        :param urgent: поставить в начало очереди. Для продолжений задач, которые не должны ждать новые задачи
+        :param job: продолжить эту работу, по умолчанию создается новая. Результатом fn может быть та же работа,
+        тогда она продолжается задачей, которую поставила fn. Если продолжение объединено с ожидающей задачей
+        другой работы, job завершится вместе с той работой
+        :return: Job
+        """
+        with self._lock:
+            pending = self._find_pending(key)
+            if pending is not None:
+                if supersedes is not None and supersedes(pending):
+                    log.info('Task %s %s supersedes pending %s', name, args, pending.args)
+                    pending.fn = fn
+                    pending.args = args
+                else:
+                    log.info('Task %s %s merged with pending one', name, args)
+                if job is not None and job is not pending.job:
+                    self._follow(job, pending.job)
+                return pending.job
+
+            if job is None:
+                job = Job(name, self._on_change)
+                self._add_job(job)
+            task = Task(name, resources, fn, args, key, job)
+            if urgent:
+                self._pending.insert(0, task)
+            else:
+                self._pending.append(task)
+            self._dispatch()
+        self._on_change()
+        return job
+
+    @staticmethod
+    def _follow(job, leader):
+        """
+        Завершает job с результатом leader
+        """
+        def done(future):
+            error = future.exception()
+            job.finish(None if error is not None else future.result(), error)
+
+        leader.future.add_done_callback(done)
+
+    def _add_job(self, job):
+        # вызывается под self._lock
+        self._jobs[job.id] = job
+        finished = [j.id for j in self._jobs.values() if j.finished is not None]
+        for job_id in finished[:max(0, len(self._jobs) - self.JOBS_HISTORY)]:
+            del self._jobs[job_id]
+
+    def job(self, job_id):
+        """
+        :return: Job или None, если такой работы нет или она давно завершилась
+        """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def _find_pending(self, key):
+        if key is None:
+            return None
+        for task in self._pending:
+            if task.key == key:
+                return task
+        return None
+
+    def _dispatch(self):
+        # вызывается под self._lock
+        busy = set()
+        for task in self._running:
+            busy |= task.resources
+        # ресурсы задач, ожидающих раньше в очереди. Их не обгоняем
+        blocked = set()
+        for task in list(self._pending):
+            if len(self._running) >= self.max_workers:
+                return
+            if task.resources & busy or task.resources & blocked:
+                blocked |= task.resources
+                continue
+            self._pending.remove(task)
+            self._running.append(task)
+            busy |= task.resources
+            task.state = Task.RUNNING
+            task.started = time.time()
+            self._executor.submit(self._run, task)
+
+    def _run(self, task):
+        _local.job = task.job
+        task.job.start()
+        result, error = None, None
+        try:
+            result = task.fn(*task.args)
+        except Exception as e:
+            error = e
+        finally:
+            _local.job = None
+        with self._lock:
+            self._running.remove(task)
+            self._dispatch()
+        # вне блокировки, колбэки могут ставить новые задачи
+        if error is not None:
+            task.job.finish(error=error)
+        elif result is not task.job:
+            task.job.finish(result)
+        self._on_change()
+
+    def status(self):
+        with self._lock:
+            return [t.status() for t in self._running + self._pending]
@@ -0,0 +1,151 @@
+import glob
+import logging
+import os
+import time
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+
+import metrics
+
+log = logging.getLogger('[test tools main]')
+
+
+class TomcatReadiness(object):
+    """
+    Ожидание запуска uni, один наблюдатель на процесс томката. Следит за логом catalina, после строки о
+    завершении запуска сразу проверяет uni по http. Если лог не найден или формат другой, uni все равно
+    проверяется, но реже. Все ожидающие получают одну future. Если uni не ответил за TIMEOUT, а томкат
+    работает, проверка продолжается по recheck
+    """
+    MARKER = b'Server startup in'
+    LOG_PATTERN = 'catalina*'
+    TICK = 0.5
+    # как часто проверять uni по http, пока в логе нет строки о запуске
+    PROBE_INTERVAL = 5
+    PROBE_TIMEOUT = 5
+    # если работают миграции то время запуска может достигать 15 минут
+    TIMEOUT = 900
+
+    def __init__(self, logs_dir, url, on_done=None):
+        """
+        Создается до запуска процесса, чтобы читать только то, что запишет новый томкат
+        :param on_done: вызывается на IOLoop, когда результат известен
+        """
+        self.logs_dir = logs_dir
+        self.url = url
+        self.on_done = on_done
+        # True - uni доступен, False - томкат остановился или не запустился за TIMEOUT
+        self.ready = Future()
+        self._offsets = {}
+        for path in self._log_files():
+            try:
+                self._offsets[path] = os.path.getsize(path)
+            except OSError:
+                # лог удалили между glob и getsize
+                pass
+        # хвост прошлого чтения, строка могла записаться частями
+        self._carry = {}
+        self._process = None
+        # наблюдатель вернул False, а процесс еще работает - uni проверяется повторно
+        self.timed_out = False
+        self._last_probe = 0
+        self._rechecking = False
+
+    def _log_files(self):
+        return [path for path in glob.glob(os.path.join(self.logs_dir, self.LOG_PATTERN)) if os.path.isfile(path)]
+
+    def start(self, process):
+        self._process = process
+        IOLoop.instance().add_callback(self._watch)
+
+    def _startup_logged(self):
+        found = False
+        for path in self._log_files():
+            offset = self._offsets.get(path, 0)
+            try:
+                if os.path.getsize(path) < offset:
+                    # файл перезаписали
+                    offset = 0
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    data = self._carry.get(path, b'') + f.read()
+                    self._offsets[path] = f.tell()
+            except OSError as e:
+                # логи ротируются, файл мог пропасть после glob
+                log.debug('Cannot read %s: %s', path, e)
+                continue
+            if self.MARKER in data:
+                found = True
+            self._carry[path] = data[-len(self.MARKER):]
+        return found
+
+    @gen.coroutine
+    def _probe(self):
+        self._last_probe = time.time()
+        try:
+            yield AsyncHTTPClient().fetch(self.url, request_timeout=self.PROBE_TIMEOUT)
+        except Exception as e:
+            # HTTPError - ответ с ошибкой или таймаут, OSError - порт еще не открыт
+            log.debug('Uni probe failed: %s', e)
+            raise gen.Return(False)
+        raise gen.Return(True)
+
+    @gen.coroutine
+    def _watch(self):
+        started = time.time()
+        logged = False
+        result = False
+        try:
+            while time.time() - started < self.TIMEOUT and self._process.poll() is None:
+                if not logged:
+                    logged = self._startup_logged()
+                if logged or time.time() - self._last_probe >= self.PROBE_INTERVAL:
+                    if (yield self._probe()):
+                        result = True
+                        break
+                yield gen.sleep(self.TICK)
+        except Exception as e:
+            log.exception('Tomcat readiness watch failed: %s', e)
+        finally:
+            # ожидающие не должны висеть, даже если наблюдатель упал
+            if result:
+                metrics.observe('test_tools_phase_duration_seconds', time.time() - started, phase='tomcat startup')
+                log.info('Uni is available after %.1f sec', time.time() - started)
+            else:
+                self.timed_out = self._process.poll() is None
+                log.warning('Uni is not available')
+            self._resolve(result)
+
+    def _resolve(self, result):
+        if self.ready.done():
+            # повторная проверка после таймаута: новые ожидающие получают новый результат
+            self.ready = Future()
+        self.ready.set_result(result)
+        if self.on_done:
+            self.on_done()
+
+    def recheck(self):
+        """
+        Томкат мог запуститься позже TIMEOUT (долгие миграции). После таймаута uni проверяется по http
+        не чаще PROBE_INTERVAL, пока процесс работает. Вызывается периодически на IOLoop
+        """
+        if not self.timed_out or self._rechecking or time.time() - self._last_probe < self.PROBE_INTERVAL:
+            return
+        if self._process.poll() is not None:
+            self.timed_out = False
+            return
+        self._rechecking = True
+        IOLoop.current().add_callback(self._recheck)
+
+    @gen.coroutine
+    def _recheck(self):
+        try:
+            if (yield self._probe()):
+                log.info('Uni became available after readiness timeout')
+                self.timed_out = False
+                self._resolve(True)
+        finally:
+            self._rechecking = False
@@ -1,10 +1,10 @@
+import datetime
+import json
 import logging
 import os
-import time
-from concurrent.futures import ThreadPoolExecutor
 
 from tornado import gen
-from tornado.httpclient import AsyncHTTPClient, HTTPError
+from tornado.iostream import StreamClosedError
 from tornado.web import RequestHandler
 
 from engine import Engine
@@ -14,31 +14,23 @@ log = logging.getLogger('[test tools main]')
 
 class ActionHandler(RequestHandler):
     ENGINE_STATUS = 'engine_status'
-    LONG_ACTIONS = ('update', 'reduce', 'backup', 'restore', 'build_and_update',
+    METRICS = 'metrics'
+    LONG_ACTIONS = ('update', 'reduce', 'backup', 'restore', 'restore_reduced', 'build_and_update',
                     'new_db', 'drop_db')
     CHECK_UNI_ACTION = 'check_uni'
     TOMCAT = ('start_tomcat', 'stop_tomcat')
-    # использую внутреннюю очередь tpe чтобы в любой момент времени выполнялась только одна длинная задача
-    # т. е. один поток на выполнение длинных задач. Нельзя выполнять параллельно
-    TPE = ThreadPoolExecutor(max_workers=1)
 
     @gen.coroutine
     def _check_uni(self):
         log.info('Check uni')
         engine = self.application.engine
         assert isinstance(engine, Engine)
-        cl = AsyncHTTPClient()
-        # если работают миграции то время запуска может достигать 15 минут
-        deadline = time.time() + 900
+        # запуск ждет один наблюдатель на процесс томката, все запросы получают его результат
+        readiness = engine.tomcat_readiness
         # Если томкат остановлен, значит уни точно недоступен
-        while engine.tomcat.poll() is None and time.time() < deadline:
-            try:
-                yield cl.fetch('http://localhost:{0}/'.format(engine.config.UNI_PORT), request_timeout=900)
-                log.info('Uni is available')
-                self.finish({'status': 'ok', 'details': 'Uni is available'})
-                return
-            except (ConnectionError, HTTPError):
-                yield gen.sleep(5)
+        if engine.tomcat is not None and engine.tomcat.poll() is None and (yield readiness.ready):
+            self.finish({'status': 'ok', 'details': 'Uni is available'})
+            return
 
         self.set_status(400, 'Uni is not available')
         self.finish({'status': 'fail', 'error': 'Uni is not available'})
@@ -46,10 +38,11 @@ class ActionHandler(RequestHandler):
     @gen.coroutine
     def get(self, action):
         """
-        Помещает "длинные" задачи в очередь задач. Редирект на главную страницу, которая отобразит текущий статус
+        Помещает "длинные" задачи в очередь задач. Сразу возвращает id работы, ее статус доступен в /jobs/<id>
 
         ?sync=1 -> html response только после завершения запроса. Если в очереди много задач будет ждать их
         полного выполения. Вернет стасус выполнения задачи после завершения.
+        Для долгих задач лучше не держать соединение, а ждать через /jobs/<id>?wait=<сек>
         """
         engine = self.application.engine
 
@@ -61,25 +54,31 @@ class ActionHandler(RequestHandler):
             log.info('New task: %s', action)
             sync = self.get_argument('sync', False)
 
-            if sync:
-                yield self.TPE.submit(engine.log_exceptions, getattr(engine, action))
+            job = engine.submit(action)
 
-                if not self.application.engine.last_error:
-                    self.finish({'status': 'ok'})
-                else:
+            if sync:
+                try:
+                    yield job.future
+                except Exception:
                     self.set_status(400, 'Error while test tools action')
-                    self.finish({'status': 'fail', 'error': engine.last_error})
+                    self.finish({'status': 'fail', 'error': job.error, 'job': job.id})
+                    return
+                self.finish({'status': 'ok', 'job': job.id})
                 return
 
             if not sync:
-                self.TPE.submit(engine.log_exceptions, getattr(engine, action))
-                self.finish('Task added')
+                self.finish({'status': 'added', 'job': job.id, 'url': '/jobs/' + job.id})
                 return
 
         if action == self.ENGINE_STATUS:
             self.finish(engine.engine_status())
             return
 
+        if action == self.METRICS:
+            self.set_header('Content-Type', 'text/plain; version=0.0.4')
+            self.finish(engine.render_metrics())
+            return
+
         if action in self.TOMCAT:
             getattr(engine, action)()
             self.redirect('/')
@@ -89,6 +88,76 @@ class ActionHandler(RequestHandler):
         self.finish({'status': 'not found', 'error': 'invalid action'})
 
 
+class JobHandler(RequestHandler):
+    # дольше держать соединение не даем, клиент повторит запрос
+    MAX_WAIT = 300
+
+    @gen.coroutine
+    def get(self, job_id):
+        """
+        /jobs - список работ, /jobs/<id> - статус работы: состояние, текущий этап, длительность этапов, ошибка
+
+        ?wait=<сек> -> ответ после завершения работы или через указанное время
+        """
+        engine = self.application.engine
+
+        if not job_id:
+            self.finish({'jobs': [job.status() for job in engine.jobs()]})
+            return
+
+        job = engine.job(job_id)
+        if job is None:
+            self.set_status(404, 'job not found')
+            self.finish({'status': 'not found', 'error': 'job not found'})
+            return
+
+        try:
+            wait = float(self.get_argument('wait', 0))
+        except ValueError:
+            wait = -1
+        # not 0 <= wait отсекает и nan
+        if not 0 <= wait:
+            self.set_status(400, 'invalid wait')
+            self.finish({'status': 'fail', 'error': 'wait must be a non-negative number of seconds'})
+            return
+        wait = min(wait, self.MAX_WAIT)
+        if wait > 0 and not job.future.done():
+            try:
+                yield gen.with_timeout(datetime.timedelta(seconds=wait), job.future)
+            except Exception:
+                # истекло время ожидания или работа завершилась с ошибкой, и то и другое видно в статусе
+                pass
+
+        self.finish(job.status())
+
+
+class StatusEventsHandler(RequestHandler):
+    # комментарий раз в KEEPALIVE секунд, чтобы прокси не рвали соединение и закрытые вкладки отваливались
+    KEEPALIVE = 15
+
+    @gen.coroutine
+    def get(self):
+        """
+        Server-sent events: текущий статус engine сразу после подключения и затем после каждого изменения
+        """
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        status = self.application.engine.status
+        version = None
+        try:
+            while True:
+                if version is not None:
+                    if not (yield status.wait(version, self.KEEPALIVE)):
+                        self.write(': keepalive\n\n')
+                        yield self.flush()
+                        continue
+                version, state = status.snapshot()
+                self.write('id: {}\ndata: {}\n\n'.format(version, json.dumps(state)))
+                yield self.flush()
+        except StreamClosedError:
+            pass
+
+
 class MainPageHandler(RequestHandler):
     with open(os.path.join(os.path.dirname(__file__), 'html', 'main_page.html')) as f:
         HTML_TEMPLATE = f.read()
@@ -0,0 +1,296 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+log = logging.getLogger('[test tools webapp]')
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def download(session, url, path, max_bytes_per_sec=None, timeout=60):
+    """
+    Потоково скачивает файл, считая md5 по ходу загрузки. Оборванная загрузка определяется по Content-Length
+    :param session: requests.Session с авторизацией
+    :param max_bytes_per_sec: ограничение скорости, None - без ограничения
+    :param timeout: секунд на соединение и на ожидание каждой порции данных. Без него зависшее соединение
+    держит загрузку, а с ней и все следующие обновления, бесконечно
+    :return: md5 скачанного файла
+    """
+    log.debug('Download %s to %s', url, path)
+    md5 = hashlib.md5()
+    size = 0
+    started = time.time()
+    response = session.get(url, stream=True, timeout=(timeout, timeout))
+    try:
+        response.raise_for_status()
+        # при сжатии при передаче длина не совпадет с распакованными данными
+        expected_size = None
+        if 'Content-Encoding' not in response.headers and 'Content-Length' in response.headers:
+            expected_size = int(response.headers['Content-Length'])
+        with open(path, 'wb') as f:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                md5.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+                if max_bytes_per_sec:
+                    ahead = size / max_bytes_per_sec - (time.time() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+    finally:
+        response.close()
+    if expected_size is not None and size != expected_size:
+        raise RuntimeError('Download of {} is incomplete: {} of {} bytes'.format(url, size, expected_size))
+    metrics.inc('test_tools_bytes_total', size, operation='jenkins_download')
+    log.debug('Downloaded %s bytes, md5 %s', size, md5.hexdigest())
+    return md5.hexdigest()
+
+
+def _extract_members(war_file, names, dir_for_files):
+    # у каждого потока свой ZipFile, распаковка zlib отпускает GIL
+    with zipfile.ZipFile(war_file) as f:
+        for name in names:
+            f.extract(name, path=dir_for_files)
+
+
+def unpack(war_file, dir_for_files, workers=None, names=None):
+    """
+    Распаковывает war в несколько потоков. Проверка crc каждого файла делается при распаковке
+    :param names: распаковать только эти файлы, по умолчанию все
+    """
+    workers = workers or os.cpu_count() or 1
+    with zipfile.ZipFile(war_file) as f:
+        members = f.infolist()
+    if names is not None:
+        names = set(names)
+        members = [m for m in members if m.filename in names]
+
+    # директории создаем заранее, иначе потоки будут создавать их наперегонки
+    files = []
+    for member in members:
+        if member.filename.endswith('/'):
+            os.makedirs(os.path.join(dir_for_files, member.filename), exist_ok=True)
+        else:
+            os.makedirs(os.path.join(dir_for_files, os.path.dirname(member.filename)), exist_ok=True)
+            files.append(member)
+
+    # раскладываем по потокам так, чтобы объем несжатых данных был примерно одинаковым
+    files.sort(key=lambda m: m.file_size, reverse=True)
+    parts = [[] for _ in range(workers)]
+    sizes = [0] * workers
+    for member in files:
+        i = sizes.index(min(sizes))
+        parts[i].append(member.filename)
+        sizes[i] += member.file_size
+
+    metrics.inc('test_tools_bytes_total', sum(sizes), operation='webapp_unpack')
+    log.debug('Unpack %s files in %s threads', len(files), workers)
+    with ThreadPoolExecutor(max_workers=workers) as tpe:
+        futures = [tpe.submit(_extract_members, war_file, names, dir_for_files) for names in parts if names]
+        for future in futures:
+            future.result()
+
+
+def _war_manifest(war_file):
+    """
+    {имя файла: [crc32, размер]} по центральному каталогу war, без распаковки
+    """
+    with zipfile.ZipFile(war_file) as f:
+        return {m.filename: [m.CRC, m.file_size] for m in f.infolist() if not m.filename.endswith('/')}
+
+
+def _read_manifest(manifest_path):
+    try:
+        with open(manifest_path, 'rt') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def deploy(war_file, dir_for_files, manifest_path, incremental=True):
+    """
+    Разворачивает war в директорию. Содержимое развернутой директории описывается манифестом (crc и размер
+    каждого файла). В инкрементальном режиме переписываются только новые и измененные файлы и удаляются
+    лишние, без манифеста директория разворачивается заново целиком.
+    Манифест лежит вне директории, чтобы томкат его не раздавал
+    """
+    new_manifest = _war_manifest(war_file)
+    old_manifest = _read_manifest(manifest_path) if incremental else None
+    # пока директория меняется манифест недействителен, прерванный деплой в следующий раз пройдет полностью
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    if old_manifest is None:
+        log.debug('Full deploy to %s', dir_for_files)
+        shutil.rmtree(dir_for_files)
+        os.mkdir(dir_for_files)
+        unpack(war_file, dir_for_files)
+    else:
+        changed = []
+        for name, (crc, size) in new_manifest.items():
+            path = os.path.join(dir_for_files, name)
+            # если файл поменяли руками, размер скорее всего не совпадет
+            if old_manifest.get(name) != [crc, size] or not os.path.isfile(path) or os.path.getsize(path) != size:
+                changed.append(name)
+        removed = [name for name in old_manifest if name not in new_manifest]
+        log.info('Incremental deploy to %s: %s changed, %s removed, %s unchanged', dir_for_files,
+                 len(changed), len(removed), len(new_manifest) - len(changed))
+
+        for name in removed:
+            path = os.path.join(dir_for_files, name)
+            if os.path.isfile(path):
+                os.remove(path)
+            # убираем опустевшие директории
+            parent = os.path.dirname(path)
+            while parent != dir_for_files and os.path.isdir(parent) and not os.listdir(parent):
+                os.rmdir(parent)
+                parent = os.path.dirname(parent)
+        unpack(war_file, dir_for_files, names=changed)
+
+    with open(manifest_path, 'wt') as f:
+        json.dump(new_manifest, f)
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class ArtifactCache(object):
+    """
+    Локальный кэш war файлов сборок: <директория кэша>/<проект>/<номер сборки>-<отпечаток>/artifact.war и meta.json.
+    Отпечаток - md5 артефакта из fingerprint jenkins, скачанный файл с ним сверяется до попадания в кэш.
+    В meta.json md5, описание сборки и время последнего использования.
+    Перед выдачей md5 проверяется, при превышении размера удаляются давно не используемые сборки
+    """
+    WAR_NAME = 'artifact.war'
+    META_NAME = 'meta.json'
+    # для job без записи отпечатков. Такой артефакт проверяется только по Content-Length при загрузке
+    NO_FINGERPRINT = 'nofingerprint'
+    # недокачанный файл старше этого считается брошенным и может быть удален
+    STALE_DOWNLOAD_SECONDS = 3600
+
+    def __init__(self, cache_dir, max_size_gb):
+        self.cache_dir = cache_dir
+        # из переменных среды приходит строка
+        self.max_size = int(float(max_size_gb) * 1024 ** 3)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_dir(self, project, build_number, fingerprint):
+        return os.path.join(self.cache_dir, project, '{}-{}'.format(build_number, fingerprint or self.NO_FINGERPRINT))
+
+    def get(self, project, build_number, fingerprint):
+        """
+        :param fingerprint: md5 артефакта по данным jenkins, None если jenkins отпечаток не записал
+        :return: (путь к war, описание сборки) или None если сборки нет в кэше или файл испорчен
+        """
+        entry_dir = self._entry_dir(project, build_number, fingerprint)
+        try:
+            with open(os.path.join(entry_dir, self.META_NAME), 'rt') as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        war_file = os.path.join(entry_dir, self.WAR_NAME)
+        if not os.path.exists(war_file) or file_md5(war_file) != meta['md5']:
+            log.warning('Cached artifact of %s build %s is broken, remove it', project, build_number)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+
+        log.info('Use cached artifact of %s build %s', project, build_number)
+        meta['last_used'] = time.time()
+        self._write_meta(entry_dir, meta)
+        return war_file, meta['build_details']
+
+    def find(self, project, build_number):
+        """
+        Сборка из кэша по одному номеру, без отпечатка jenkins. Нужна, чтобы разворачивать известную сборку
+        без обращений к jenkins. Записи с отпечатком проверяются первыми
+        :return: (путь к war, описание сборки) или None
+        """
+        project_dir = os.path.join(self.cache_dir, project)
+        prefix = '{}-'.format(build_number)
+        try:
+            entries = [name for name in os.listdir(project_dir) if name.startswith(prefix)]
+        except FileNotFoundError:
+            return None
+        fingerprints = [name[len(prefix):] for name in entries
+                        if not self._downloading(os.path.join(project_dir, name))]
+        for fingerprint in sorted(fingerprints, key=lambda fp: fp == self.NO_FINGERPRINT):
+            cached = self.get(project, build_number, None if fingerprint == self.NO_FINGERPRINT else fingerprint)
+            if cached:
+                return cached
+        return None
+
+    def download_path(self, project, build_number, fingerprint):
+        """
+        Куда скачивать артефакт перед add
+        """
+        entry_dir = self._entry_dir(project, build_number, fingerprint)
+        os.makedirs(entry_dir, exist_ok=True)
+        return os.path.join(entry_dir, self.WAR_NAME + '.tmp')
+
+    def add(self, project, build_number, fingerprint, downloaded_file, md5, build_details):
+        """
+        Кладет скачанный артефакт в кэш и удаляет лишнее
+        :raise RuntimeError: md5 скачанного файла не совпал с отпечатком jenkins
+        :return: путь к war в кэше
+        """
+        if fingerprint and md5 != fingerprint:
+            os.remove(downloaded_file)
+            raise RuntimeError('Downloaded artifact of {} build {} is broken: md5 {}, jenkins fingerprint {}'
+                               .format(project, build_number, md5, fingerprint))
+        entry_dir = self._entry_dir(project, build_number, fingerprint)
+        war_file = os.path.join(entry_dir, self.WAR_NAME)
+        os.replace(downloaded_file, war_file)
+        self._write_meta(entry_dir, {'md5': md5, 'build_details': build_details, 'last_used': time.time()})
+        self._evict(keep=entry_dir)
+        return war_file
+
+    def _downloading(self, entry_dir):
+        try:
+            modified = os.path.getmtime(os.path.join(entry_dir, self.WAR_NAME + '.tmp'))
+        except OSError:
+            return False
+        return time.time() - modified < self.STALE_DOWNLOAD_SECONDS
+
+    def _write_meta(self, entry_dir, meta):
+        with open(os.path.join(entry_dir, self.META_NAME), 'wt') as f:
+            json.dump(meta, f)
+
+    def _evict(self, keep):
+        entries = []
+        for project in os.listdir(self.cache_dir):
+            project_dir = os.path.join(self.cache_dir, project)
+            for build in os.listdir(project_dir):
+                entry_dir = os.path.join(project_dir, build)
+                if self._downloading(entry_dir):
+                    continue
+                try:
+                    with open(os.path.join(entry_dir, self.META_NAME), 'rt') as f:
+                        last_used = json.load(f)['last_used']
+                    size = os.path.getsize(os.path.join(entry_dir, self.WAR_NAME))
+                except (OSError, ValueError, KeyError):
+                    # недокачанная или испорченная запись
+                    last_used, size = 0, 0
+                entries.append((last_used, size, entry_dir))
+
+        total = sum(size for _, size, _ in entries)
+        # самые давно используемые в начале
+        for last_used, size, entry_dir in sorted(entries):
+            if total <= self.max_size:
+                break
+            if entry_dir == keep:
+                continue
+            log.info('Remove cached artifact %s', entry_dir)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size